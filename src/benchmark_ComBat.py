@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import itertools
+import tracemalloc
+import importlib
+import numpy as np
+import pandas as pd
+from deriv_store import write_deriv, deriv_path, FORMATS
+from stratified_ComBat import MODS, load_models
+
+PROJECT_ROOT = "/Users/vgonzenb/PennSIVE/MSKIDS/"
+BENCHMARKS_DIR = os.path.join("results", "benchmarks")
+DATA_DIR = os.path.join("data", "deriv")
+MODELS_DIR = os.path.join("results", "models")
+
+SPLITS = (None, "MF")
+SEXES = ("MALE", "FEMALE")
+
+
+## Synthetic cohorts
+
+def synthetic_cohort(n_sites=4, n_per_site=150, n_features=145, age_range=(8, 20), age_shift=0.0, male_frac=0.5,
+                     ms_frac=0.0, gamma_sd=0.5, delta_sd=0.3, seed=0, truth=None):
+    """
+    Draws a cohort in the layout of data/deriv/HC_data: ID, scanner, site, age, sex, DLICV and ROIs R0, R1, ...
+
+    Ages are uniform over age_range, shifted by age_shift years from one site to the next (confounding site and age).
+    Each volume is a smooth function of age, plus a sex effect, a share of the (true) ICV for ROIs, an atrophy
+    effect for the ms_frac of subjects with MS, and noise; each site then shifts it by gamma and scales the noise
+    by sqrt(delta), both in units of the noise sd. gamma ~ N(0, gamma_sd) and log(delta) ~ N(0, delta_sd).
+
+    Returns the DataFrame and the injected site effects, {'sites', 'gamma', 'delta'} with one column per
+    volume (DLICV first). Passing the truth of a cohort draws another one with the same effects (e.g. patients).
+    """
+    rng = np.random.default_rng(seed)
+    sites = [f"SITE{i}" for i in range(n_sites)]
+    n_volumes = n_features + 1
+    if truth is None:
+        params = np.random.default_rng(0) # volume and site effects are fixed across draws
+        truth = {'sites': sites,
+                 'gamma': params.normal(0, gamma_sd, (n_sites, n_volumes)),
+                 'delta': np.exp(params.normal(0, delta_sd, (n_sites, n_volumes))),
+                 'base': params.uniform(1e3, 1e4, n_volumes), 'age_coef': params.normal(0, 0.05, n_volumes),
+                 'sex_coef': params.normal(0, 0.03, n_volumes), 'icv_share': params.uniform(1e-4, 5e-3, n_volumes),
+                 'ms_coef': -np.abs(params.normal(0, 0.05, n_volumes))}
+
+    n = n_sites * n_per_site
+    site = np.repeat(np.arange(n_sites), n_per_site)
+    age = rng.uniform(*age_range, n) + age_shift * site
+    male = rng.random(n) < male_frac
+    ms = rng.random(n) < ms_frac
+
+    # relative volumes: smooth age trajectory, sex, MS; ICV adds to the ROIs through its true (unharmonized) value
+    t = (age - age_range[0]) / (age_range[1] - age_range[0])
+    relative = (1 + np.outer(np.sin(np.pi * t) - 0.5, truth['age_coef'])
+                + np.outer(male, truth['sex_coef']) + np.outer(ms, truth['ms_coef']))
+    volumes = relative * truth['base']
+    volumes[:, 1:] += np.outer(volumes[:, 0], truth['icv_share'][1:])
+    sd = 0.05 * truth['base']
+    volumes += sd * (truth['gamma'][site] + np.sqrt(truth['delta'][site]) * rng.standard_normal((n, n_volumes)))
+
+    demographics = pd.DataFrame({'ID': [f"SUB{seed}-{i:06d}" for i in range(n)],
+                                 'scanner': "SIEMENSTIMTRIO", 'site': np.asarray(sites)[site], 'age': age,
+                                 'sex': np.where(male, "MALE", "FEMALE")})
+    features = pd.DataFrame(volumes, columns=['DLICV'] + [f"R{j}" for j in range(n_features)])
+    return pd.concat([demographics, features], axis=1), truth
+
+def site_recovery(models, data, truth):
+    """
+    Compares the ROI models' site effects to the injected ones: gamma_star against gamma relative to the
+    site-weighted mean, delta_star against delta relative to the site-weighted mean (what ComBat estimates).
+    Returns the RMSE and correlation of each, pooled over strata.
+    """
+    gammas, deltas = [], []
+    for key, (_, model_rois) in models.items():
+        stratum = data if key is None else data[data.sex == key]
+        sites = list(model_rois['SITE_labels'])
+        rows = [truth['sites'].index(site) for site in sites]
+        w = stratum.site.value_counts()[sites].to_numpy(dtype=float)
+        w /= w.sum()
+        gamma, delta = truth['gamma'][rows, 1:], truth['delta'][rows, 1:]
+        scale = w @ delta
+        gammas.append((np.asarray(model_rois['gamma_star']), (gamma - w @ gamma) / np.sqrt(scale)))
+        deltas.append((np.asarray(model_rois['delta_star']), delta / scale))
+
+    recovery = {}
+    for name, pairs in (('gamma', gammas), ('delta', deltas)):
+        est = np.concatenate([p[0].ravel() for p in pairs])
+        true = np.concatenate([p[1].ravel() for p in pairs])
+        recovery[f'{name}_rmse'] = float(np.sqrt(np.mean((est - true) ** 2)))
+        recovery[f'{name}_corr'] = float(np.corrcoef(est, true)[0, 1])
+    return recovery
+
+
+## Stages
+
+def _stages(mod, eb, split, fmt, n_jobs):
+    """(stage, script, function, kwargs) run for one combination; the apply scripts use eb=True models only."""
+    ext = FORMATS[fmt]
+    if split is None:
+        yield "learn", "learn_ComBat-GAM", "harmonize_data", dict(data_file="HC_data" + ext, mod=mod, eb=eb,
+                                                                 cache=False, fmt=fmt)
+        if mod == "GAM" and eb:
+            yield "apply", "apply_ComBat-GAM", "apply_harmonization", dict(data_file="MS_data" + ext, fmt=fmt)
+    else:
+        yield "learn", "learn_ComBat_by_sex", "harmonize_data_by_sex", dict(data_file="HC_data" + ext, mod=mod, eb=eb,
+                                                                           n_jobs=n_jobs, cache=False, fmt=fmt)
+        if eb:
+            yield "apply", "apply_ComBat_by_sex", "apply_harmonization_by_sex", dict(data_file="MS_data" + ext, mod=mod,
+                                                                                   n_jobs=n_jobs, fmt=fmt)
+        yield "learn_all", "learn_apply_ComBat_to_all", "harmonize_all_data_by_sex", dict(
+            data_file1="HC_data" + ext, data_file2="MS_data" + ext, mod=mod, eb=eb, n_jobs=n_jobs, cache=False, fmt=fmt)
+
+def _cpu_time():
+    """CPU time of this process and of its finished child processes (the workers of stages run with n_jobs > 1)."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def _run_stage(fn, kwargs, repeat, memory):
+    """Best wall and CPU time over repeat runs, then the peak traced allocation of one more run."""
+    record = {}
+    walls, cpus = [], []
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), _cpu_time()
+        fn(**kwargs)
+        walls.append(time.perf_counter() - wall)
+        cpus.append(_cpu_time() - cpu)
+    record.update({'wall_s': min(walls), 'cpu_s': min(cpus)})
+    if memory:
+        tracemalloc.start()
+        try:
+            fn(**kwargs)
+            record['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return record
+
+def run_benchmarks(name=None, mods=MODS, ebs=(True, False), splits=SPLITS, repeat=1, memory=True, fmt="csv",
+                   n_jobs=1, compare=None, **cohort):
+    """
+    Times (and, with memory, memory-profiles) the learn and apply scripts on synthetic cohorts for each
+    combination of mods x ebs x splits, run in a scratch project directory.
+
+    cohort sets the synthetic healthy controls (see synthetic_cohort: n_sites, n_per_site, n_features,
+    age_range, age_shift, male_frac, ...); a cohort a quarter the size, half with MS, is drawn from the same
+    sites as patients. After each learn stage, the injected site effects are compared to the learned ones.
+
+    The per-sex stages run in n_jobs processes (None: one per stratum, up to the CPU count). Peak memory is traced
+    in this process only, so baselines are profiled in-process (n_jobs=1) unless parallel wall time is wanted.
+
+    With name, the results are saved as results/benchmarks/{name}.json; with compare, they are checked against
+    the baseline results/benchmarks/{compare}.json and the regressions are printed.
+    Returns the results as a dict.
+    """
+    hc, truth = synthetic_cohort(**cohort)
+    ms_cohort = dict(cohort, n_per_site=max(cohort.get('n_per_site', 150) // 4, 2), ms_frac=0.5,
+                     seed=cohort.get('seed', 0) + 1)
+    ms, _ = synthetic_cohort(**ms_cohort, truth=truth)
+    ms['age'] = ms['age'].clip(hc.age.min(), hc.age.max()) # within the training range of the age splines
+
+    root = tempfile.mkdtemp(prefix="benchmark_ComBat_") + os.sep
+    records = []
+    try:
+        os.makedirs(root + DATA_DIR)
+        os.makedirs(root + MODELS_DIR)
+        write_deriv(hc, deriv_path(root + DATA_DIR, "HC_data", fmt))
+        write_deriv(ms, deriv_path(root + DATA_DIR, "MS_data", fmt))
+
+        for mod, eb, split in itertools.product(mods, ebs, splits):
+            for stage, script, function, kwargs in _stages(mod, eb, split, fmt, n_jobs):
+                module = importlib.import_module(script)
+                module.PROJECT_ROOT = root
+                record = {'mod': mod, 'eb': eb, 'split': split, 'stage': stage, 'function': function}
+                try:
+                    record.update(_run_stage(getattr(module, function), kwargs, repeat, memory))
+                    record['status'] = "ok"
+                except Exception as error:
+                    record['status'] = f"{type(error).__name__}: {error}"
+                if stage == "learn" and record['status'] == "ok":
+                    keys = (None,) if split is None else SEXES
+                    models = load_models(root + MODELS_DIR, mod, "HC_data", eb, keys)
+                    record.update(site_recovery(models, hc, truth))
+                records.append(record)
+                print(_describe(record))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    cohort = {'n_sites': hc.site.nunique(), 'n_hc': len(hc), 'n_ms': len(ms), 'n_features': hc.shape[1] - 6, **cohort}
+    results = {'cohort': json.loads(json.dumps(cohort, default=_jsonable)), # as it reads back from a baseline
+               'repeat': repeat, 'fmt': fmt, 'n_jobs': n_jobs,
+               'platform': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                            'machine': platform.machine(), 'cpus': os.cpu_count()},
+               'records': records}
+
+    if name is not None:
+        os.makedirs(PROJECT_ROOT + BENCHMARKS_DIR, exist_ok=True)
+        with open(benchmark_path(name), 'w') as f:
+            json.dump(results, f, indent=1, default=_jsonable)
+    if compare is not None:
+        print(compare_benchmarks(load_benchmark(compare), results).to_string(index=False))
+    return results
+
+
+## Baselines
+
+def benchmark_path(name):
+    return os.path.join(PROJECT_ROOT + BENCHMARKS_DIR, f'{name}.json')
+
+def load_benchmark(name):
+    with open(benchmark_path(name)) as f:
+        return json.load(f)
+
+def compare_benchmarks(baseline, current, time_tol=0.25, mem_tol=0.25, recovery_tol=0.02, min_seconds=0.1):
+    """
+    Matches the records of two benchmark results by (mod, eb, split, stage) and flags regressions: wall time or
+    peak memory more than time_tol/mem_tol above the baseline (time differences under min_seconds are noise),
+    site-effect recovery RMSE more than recovery_tol above it, or a stage that no longer runs.
+    """
+    if baseline['cohort'] != current['cohort']:
+        print(f"warning: cohorts differ: {baseline['cohort']} vs {current['cohort']}", file=sys.stderr)
+    if baseline.get('n_jobs') != current['n_jobs']:
+        print(f"warning: n_jobs differ: {baseline.get('n_jobs')} vs {current['n_jobs']}", file=sys.stderr)
+
+    def keyed(results):
+        return {(r['mod'], r['eb'], r['split'], r['stage']): r for r in results['records']}
+    base, new = keyed(baseline), keyed(current)
+
+    rows = []
+    for key in [k for k in new if k in base]:
+        b, c = base[key], new[key]
+        row = dict(zip(('mod', 'eb', 'split', 'stage'), key))
+        flags = []
+        if b['status'] == "ok" and c['status'] != "ok":
+            flags.append("fails")
+        if 'wall_s' in b and 'wall_s' in c:
+            row.update({'wall_s': c['wall_s'], 'wall_ratio': c['wall_s'] / b['wall_s']})
+            if c['wall_s'] > b['wall_s'] * (1 + time_tol) and c['wall_s'] - b['wall_s'] > min_seconds:
+                flags.append("time")
+        if 'peak_mb' in b and 'peak_mb' in c:
+            row.update({'peak_mb': c['peak_mb'], 'mem_ratio': c['peak_mb'] / b['peak_mb']})
+            if c['peak_mb'] > b['peak_mb'] * (1 + mem_tol):
+                flags.append("memory")
+        for stat in ('gamma_rmse', 'delta_rmse'):
+            if stat in b and stat in c and c[stat] > b[stat] + recovery_tol:
+                flags.append(stat.split('_')[0])
+        row['regression'] = ",".join(flags)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def _describe(record):
+    split = record['split'] or "None"
+    if record['status'] != "ok":
+        return f"{record['mod']:6} eb={record['eb']!s:5} split={split:4} {record['stage']:9} {record['status']}"
+    text = f"{record['mod']:6} eb={record['eb']!s:5} split={split:4} {record['stage']:9} {record['wall_s']:8.2f}s"
+    if 'peak_mb' in record:
+        text += f" {record['peak_mb']:9.1f}MB"
+    if 'gamma_rmse' in record:
+        text += f"  gamma rmse {record['gamma_rmse']:.3f} delta rmse {record['delta_rmse']:.3f}"
+    return text
+
+def _jsonable(x):
+    return x.item() if isinstance(x, np.generic) else str(x)
+
+if __name__ == "__main__":
+    run_benchmarks(name="baseline")
@@ -0,0 +1,757 @@
+import itertools
+import numpy as np
+import pandas as pd
+from scipy.interpolate import BSpline
+from scipy.linalg import eigh
+from pipeline_trace import stage
+
+
+class SplineBasis:
+    """
+    B-spline basis of one or more smooth terms, fixed by its knots.
+
+    Stands in for the statsmodels BSplines constructor stored in harmonizationLearn models:
+    transform() returns the same basis columns, without statsmodels or the training data.
+    penalty_matrices, if given, are the smoothness penalties fit_gam needs to refit with this basis.
+    """
+
+    def __init__(self, knots, degree=3, include_intercept=False, ctransf=None, penalty_matrices=None):
+        # one entry per smooth term
+        self.knots = [np.asarray(k) for k in knots]
+        self.degree = list(degree)
+        self.include_intercept = list(include_intercept)
+        self.ctransf = list(ctransf) if ctransf is not None else [None] * len(self.knots)
+        self.penalty_matrices = penalty_matrices
+
+    @classmethod
+    def from_bsplines(cls, bs):
+        """Copies the basis definition out of a statsmodels BSplines object."""
+        return cls([s.knots for s in bs.smoothers],
+                   [s.degree for s in bs.smoothers],
+                   [s.include_intercept for s in bs.smoothers],
+                   [getattr(s, 'ctransf', None) for s in bs.smoothers],
+                   bs.penalty_matrices)
+
+    def transform(self, x):
+        x = np.asarray(x, dtype=float).reshape(len(x), -1)
+        columns = []
+        for i, knots in enumerate(self.knots):
+            if x[:, i].min() < knots.min() or x[:, i].max() > knots.max():
+                raise ValueError(f"smooth term values fall outside the model's range [{knots.min()}, {knots.max()}]")
+            basis = BSpline.design_matrix(x[:, i], knots, self.degree[i]).toarray()
+            if not self.include_intercept[i]:
+                basis = basis[:, 1:]
+            if self.ctransf[i] is not None:
+                basis = basis @ self.ctransf[i]
+            columns.append(basis)
+        return np.hstack(columns)
+
+def site_index(covars, model):
+    """Position of each row's SITE among the model's training sites, -1 for sites the model has not seen."""
+    lookup = {site: i for i, site in enumerate(model['SITE_labels'])}
+    return np.array([lookup.get(site, -1) for site in covars['SITE']])
+
+def design_matrix(covars, model):
+    """
+    Rows of the model's training design matrix for covars, in the layout harmonizationLearn used:
+    one column per training site, then the numeric covariates, then the spline basis of any smooth terms.
+
+    Site columns come from the sites stored with the model, so covars may hold any subset of them.
+    """
+    if list(covars.columns) != list(model['Covariates']):
+        raise ValueError(f"covars columns {list(covars.columns)} do not match the model's {list(model['Covariates'])}")
+
+    sites = site_index(covars, model)
+    n_batch = len(model['SITE_labels'])
+    onehot = np.zeros((len(covars), n_batch))
+    onehot[sites >= 0, sites[sites >= 0]] = 1
+
+    ref_level = model['info_dict'].get('ref_level')
+    if ref_level is not None:
+        onehot[:, ref_level] = 1
+
+    smooth_model = model['smooth_model']
+    if smooth_model['perform_smoothing']:
+        smooth_cols = smooth_model['smooth_cols']
+        linear = [c for i, c in enumerate(covars.columns) if c != 'SITE' and i not in smooth_cols]
+        basis = smooth_model['bsplines_constructor'].transform(covars.iloc[:, smooth_cols].to_numpy(dtype=float))
+        return np.hstack([onehot, covars[linear].to_numpy(dtype=float), basis])
+
+    # neuroCombat's make_design_matrix stores numeric covariates as float32
+    numeric = covars.drop(columns='SITE').to_numpy(dtype=np.float32).astype(float)
+    return np.hstack([onehot, numeric])
+
+def apply_model(data, covars, model, out=None):
+    """
+    Applies a harmonizationLearn model to data (N_samples x N_features) without re-learning it.
+
+    Equivalent to neuroHarmonize's harmonizationApply, but the design matrix is built from the model's
+    site list, so covars may contain any subset of the training sites (even one) and no training data
+    is needed. Rows from sites the model has not seen are returned as NaN.
+    The result is written into out (N_samples x N_features) if given.
+    """
+    return _apply_design(np.asarray(data, dtype=float), design_matrix(covars, model), site_index(covars, model), model, out)
+
+def _apply_design(data, design, sites, model, out=None):
+    """apply_model for the samples' rows of the model's design and their site positions."""
+    n_batch = len(model['SITE_labels'])
+    stand_mean = model['stand_mean'][:, 0]
+    mod_mean = design[:, n_batch:] @ model['B_hat'][n_batch:]
+    sd = np.sqrt(model['var_pooled'][:, 0])
+
+    # (data - stand_mean - mod_mean) / sd, then (s_data - gamma) / sqrt(delta) * sd + stand_mean + mod_mean, in place
+    bayes_data = np.subtract(data, stand_mean, out=out)
+    bayes_data -= mod_mean
+    bayes_data /= sd
+    bayes_data -= design[:, :n_batch] @ np.asarray(model['gamma_star'])
+    bayes_data /= np.sqrt(np.asarray(model['delta_star'])[sites])
+    bayes_data *= sd
+    bayes_data += stand_mean
+    bayes_data += mod_mean
+
+    ref_level = model['info_dict'].get('ref_level')
+    if ref_level is not None:
+        bayes_data[sites == ref_level] = data[sites == ref_level]
+    bayes_data[sites < 0] = np.nan
+
+    return bayes_data
+
+
+## Location/scale model and empirical Bayes, batched over sites and features
+
+def site_moments(s_data, sites, n_batch):
+    """
+    Per-site sufficient statistics of standardized data (N_samples x N_features):
+    non-missing counts, sums and sums of squares, each N_sites x N_features.
+    """
+    observed = np.isfinite(s_data)
+    s_data = np.where(observed, s_data, 0)
+    onehot = np.zeros((len(sites), n_batch))
+    onehot[np.arange(len(sites)), sites] = 1
+    return onehot.T @ observed, onehot.T @ s_data, onehot.T @ s_data ** 2
+
+def fit_location_scale(n, s1, s2, eb=True):
+    """
+    Site location (gamma_hat) and scale (delta_hat) estimates from site moments, plus the
+    empirical Bayes hyperpriors gamma_bar, t2, a_prior and b_prior (one per site) if eb.
+    """
+    gamma_hat = s1 / n
+    delta_hat = (s2 - n * gamma_hat ** 2) / (n - 1)
+    LS = {'gamma_hat': gamma_hat, 'delta_hat': delta_hat,
+          'gamma_bar': None, 't2': None, 'a_prior': None, 'b_prior': None}
+    if eb:
+        m = delta_hat.mean(axis=1)
+        s2_delta = delta_hat.var(axis=1, ddof=1)
+        LS.update({'gamma_bar': gamma_hat.mean(axis=1),
+                   't2': gamma_hat.var(axis=1, ddof=1),
+                   'a_prior': (2 * s2_delta + m ** 2) / s2_delta,
+                   'b_prior': (m * s2_delta + m ** 3) / s2_delta})
+    return LS
+
+def eb_parametric(n, s1, s2, LS, conv=0.0001, max_iter=1000, init=None):
+    """
+    Parametric empirical Bayes estimates of gamma and delta (neuroCombat's it_sol), iterated for all sites
+    and features at once. Each site/feature stops updating once its own relative change is below conv.
+    init optionally gives the (gamma, delta) to start from instead of gamma_hat and delta_hat, e.g. the
+    estimates of a fit to similar data.
+    """
+    g_hat, d_hat = LS['gamma_hat'], LS['delta_hat']
+    g_bar, t2 = LS['gamma_bar'][:, None], LS['t2'][:, None]
+    a, b = LS['a_prior'][:, None], LS['b_prior'][:, None]
+
+    g_old, d_old = (g_hat.copy(), d_hat.copy()) if init is None else (init[0].copy(), init[1].copy())
+    active = np.ones(g_hat.shape, dtype=bool)
+    for _ in range(max_iter):
+        g_new = (t2 * n * g_hat + d_old * g_bar) / (t2 * n + d_old)
+        sum2 = s2 - 2 * g_new * s1 + n * g_new ** 2 # sum of squared residuals around g_new
+        d_new = (0.5 * sum2 + b) / (n / 2.0 + a - 1.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = np.maximum(np.abs(g_new - g_old) / np.abs(g_old), np.abs(d_new - d_old) / d_old)
+        g_old = np.where(active, g_new, g_old)
+        d_old = np.where(active, d_new, d_old)
+        active &= change > conv
+        if not active.any():
+            break
+    return g_old, d_old
+
+def eb_nonparametric(s_data, sites, LS, block=1024):
+    """
+    Non-parametric empirical Bayes estimates of gamma and delta (neuroCombat's int_eprior): for each feature,
+    the likelihood-weighted average of every other feature's estimates at the same site.
+    Likelihoods are computed for a block of features at a time, in log space to avoid underflow.
+    """
+    g_hat, d_hat = LS['gamma_hat'], LS['delta_hat']
+    gamma_star, delta_star = np.empty_like(g_hat), np.empty_like(d_hat)
+    n_features = g_hat.shape[1]
+    for i in range(g_hat.shape[0]):
+        x = s_data[sites == i]
+        n = x.shape[0]
+        g, d = g_hat[i], d_hat[i]
+        for start in range(0, n_features, block):
+            rows = slice(start, min(start + block, n_features))
+            # sum over samples of (x_k - g_j)^2, for features k in this block and all features j
+            sum2 = (x[:, rows] ** 2).sum(axis=0)[:, None] - 2 * x[:, rows].sum(axis=0)[:, None] * g + n * g ** 2
+            log_lh = -n / 2 * np.log(2 * np.pi * d) - sum2 / (2 * d)
+            log_lh[np.arange(rows.stop - rows.start), np.arange(rows.start, rows.stop)] = -np.inf # leave own estimate out
+            lh = np.exp(log_lh - log_lh.max(axis=1, keepdims=True))
+            gamma_star[i, rows] = lh @ g / lh.sum(axis=1)
+            delta_star[i, rows] = lh @ d / lh.sum(axis=1)
+    return gamma_star, delta_star
+
+
+## Penalized spline (GAM) fit, batched over features
+
+GAM_BACKENDS = ("batched", "statsmodels")
+PENWEIGHTS = ("feature", "shared")
+
+def penalty_matrix(bs, alpha, k_linear):
+    """
+    Penalty on the coefficients of a design with k_linear unpenalized columns followed by the basis of bs,
+    alpha[i] times the squared second derivative penalty of smooth term i (as statsmodels' GLMGam).
+    """
+    penalty = np.zeros((k_linear + sum(pen.shape[0] for pen in bs.penalty_matrices),) * 2)
+    start = k_linear
+    for a, pen in zip(alpha, bs.penalty_matrices):
+        end = start + pen.shape[0]
+        penalty[start:end, start:end] = a * pen
+        start = end
+    return penalty
+
+def _penalized_inverse(xtx, penalty):
+    """
+    Pseudo-inverse of the penalized normal equations xtx + 2 * penalty (statsmodels' penalized WLS weighs the
+    penalty twice), with np.linalg.pinv's cutoff applied to them scaled to the unit diagonal of xtx, so that
+    covariates on large scales (ICV_adj in mm^3) keep their directions.
+    """
+    scale = np.sqrt(np.diag(xtx))
+    scale[scale == 0] = 1
+    w, V = eigh((xtx + 2 * penalty) / np.outer(scale, scale))
+    keep = w > w.max() * 1e-15 * len(w)
+    return (V[:, keep] / w[keep]) @ V[:, keep].T / np.outer(scale, scale)
+
+def fit_gam(xtx, xty, yty, n, bs, k_linear, alphas=None, penweight="feature"):
+    """
+    Penalized least-squares fit of every feature on one shared design of n samples, given the design's
+    cross-products xtx = X'X, xty = X'Y (N_coefficients x N_features) and yty, the sums of squares of each feature.
+
+    For each candidate penalty weight, the normal equations are factorized once and solved for all features
+    as multiple right-hand sides (_penalized_inverse). Like statsmodels' pinv-based fit, this gives a minimum-norm
+    solution when the design is collinear (e.g. sex dummies alongside the site columns). The weight is picked by
+    generalized cross-validation, per feature (penweight="feature") or one for all features
+    (penweight="shared", minimizing the summed log GCV, which does not depend on the scale of each feature).
+    alphas is one grid per smooth term; by default the grid of statsmodels' select_penweight_kfold,
+    np.logspace(0, 7, 11).
+
+    Returns B_hat (N_coefficients x N_features) and the chosen weights (N_smooth_terms x N_features).
+    """
+    if penweight not in PENWEIGHTS:
+        raise ValueError(f"penweight must be one of {PENWEIGHTS}, got {penweight!r}")
+    if alphas is None:
+        alphas = [np.logspace(0, 7, 11)] * len(bs.penalty_matrices)
+    grid = list(itertools.product(*alphas))
+
+    n_features = xty.shape[1]
+    B_grid = np.empty((len(grid), xtx.shape[0], n_features))
+    gcv = np.empty((len(grid), n_features))
+    for i, alpha in enumerate(grid):
+        inv = _penalized_inverse(xtx, penalty_matrix(bs, alpha, k_linear))
+        B = inv @ xty
+        edf = (inv * xtx).sum() # trace of the hat matrix
+        rss = yty - 2 * (B * xty).sum(axis=0) + (B * (xtx @ B)).sum(axis=0)
+        B_grid[i], gcv[i] = B, n * rss / (n - edf) ** 2
+
+    if penweight == "shared":
+        best = np.full(n_features, np.log(gcv).sum(axis=1).argmin())
+    else:
+        best = gcv.argmin(axis=0)
+    return B_grid[best, :, np.arange(n_features)].T, np.array(grid).T[:, best]
+
+def solve_gam(xtx, xty, bs, k_linear, alpha):
+    """
+    Penalized least-squares fit of every feature with given penalty weights alpha (N_smooth_terms x N_features,
+    e.g. those fit_gam picked on the full data): one factorization per distinct weight instead of a GCV search.
+    Returns B_hat (N_coefficients x N_features).
+    """
+    B_hat = np.empty((xtx.shape[0], xty.shape[1]))
+    weights, which = np.unique(np.asarray(alpha).T, axis=0, return_inverse=True)
+    for i, weight in enumerate(weights):
+        cols = np.ravel(which) == i
+        B_hat[:, cols] = _penalized_inverse(xtx, penalty_matrix(bs, weight, k_linear)) @ xty[:, cols]
+    return B_hat
+
+def covariate_model(covars, smooth_terms=[]):
+    """
+    Site bookkeeping, spline basis and design matrix of a harmonizationLearn model (without a reference site)
+    for covars, to which fit_covariates adds the coefficients.
+    """
+    sites = np.unique(covars.SITE)
+    site_codes = np.searchsorted(sites, covars.SITE)
+    info_dict = {'batch_levels': np.arange(len(sites)),
+                 'n_batch': len(sites),
+                 'n_sample': len(covars),
+                 'sample_per_batch': np.bincount(site_codes, minlength=len(sites)),
+                 'batch_info': [list(np.where(site_codes == i)[0]) for i in range(len(sites))],
+                 'ref_level': None}
+
+    smooth_model = {'perform_smoothing': len(smooth_terms) > 0, 'smooth_terms': smooth_terms, 'smooth_cols': [],
+                    'bsplines_constructor': None, 'formula': None, 'df_gam': None}
+    if smooth_model['perform_smoothing']:
+        from statsmodels.gam.api import BSplines
+
+        smooth_cols = [covars.columns.get_loc(c) for c in covars.columns if c in smooth_terms]
+        linear_cols = [covars.columns.get_loc(c) for c in covars.columns if c != 'SITE' and c not in smooth_terms]
+        bs = BSplines(covars.iloc[:, smooth_cols].to_numpy(dtype=float), df=[10] * len(smooth_cols), degree=[3] * len(smooth_cols))
+        # formula and data frame of harmonizationLearn's statsmodels fit, kept so models stay interchangeable
+        df_gam = pd.DataFrame({**{f'x{i}': (site_codes == i).astype(float) for i in range(len(sites))},
+                               **{f'c{c}': covars.iloc[:, c].to_numpy(dtype=float) for c in linear_cols}})
+        smooth_model.update({'smooth_cols': smooth_cols,
+                             'bsplines_constructor': bs,
+                             'formula': 'y ~ ' + ' + '.join(df_gam.columns) + ' - 1',
+                             'df_gam': df_gam})
+
+    model = {'SITE_labels': sites, 'SITE_labels_train': sites, 'Covariates': list(covars.columns),
+             'info_dict': info_dict, 'smooth_model': smooth_model, 'ref_batch': None}
+    model['design'] = design_matrix(covars, model)
+    return model
+
+def least_squares(xtx, xty):
+    """
+    Least-squares coefficients (N_coefficients x N_features) from the cross-products of a design (xtx) and of it
+    with the data (xty). Pseudo-inverse of the cross-products scaled to unit diagonal: the minimum-norm fit even
+    when sex dummies are collinear with the site columns (unsplit Linear models), without the cutoff discarding
+    covariates on large scales (raw ICV, AGE_SQUARED).
+    """
+    scale = np.sqrt(np.diag(xtx))
+    return np.linalg.pinv(xtx / np.outer(scale, scale), hermitian=True) @ (xty / scale[:, None]) / scale[:, None]
+
+def fit_covariates(model, data, penweight="feature"):
+    """
+    Fits data (N_samples x N_features) on the design of a covariate_model, as harmonizationLearn's
+    standardizeAcrossFeatures does: penalized with fit_gam if there are smooth terms, else by least squares.
+
+    Returns B_hat, the penalty weights (None without smooth terms), the grand mean, the covariate
+    effects (N_samples x N_features) and the pooled variance of each feature.
+    """
+    design = model['design']
+    n_batch = model['info_dict']['n_batch']
+    bs = model['smooth_model']['bsplines_constructor']
+    if bs is not None:
+        k_linear = design.shape[1] - sum(pen.shape[0] for pen in bs.penalty_matrices)
+        B_hat, alpha = fit_gam(design.T @ design, design.T @ data, (data ** 2).sum(axis=0), len(design), bs, k_linear,
+                               penweight=penweight)
+    else:
+        B_hat, alpha = least_squares(design.T @ design, design.T @ data), None
+
+    grand_mean = model['info_dict']['sample_per_batch'] / model['info_dict']['n_sample'] @ B_hat[:n_batch]
+    mod_mean = design[:, n_batch:] @ B_hat[n_batch:]
+    var_pooled = ((data - design @ B_hat) ** 2).mean(axis=0)
+    return B_hat, alpha, grand_mean, mod_mean, var_pooled
+
+def adjust(data, s_data, sites, gamma_star, delta_star, sd, out=None):
+    """Standardized data back on the original scale, with site effects removed (written into out if given)."""
+    adjusted = np.subtract(s_data, gamma_star[sites], out=out)
+    adjusted /= np.sqrt(delta_star[sites])
+    adjusted -= s_data
+    adjusted *= sd
+    adjusted += data
+    return adjusted
+
+def _fit_design(model, data, penweight="feature"):
+    """Adds fit_covariates' fit of data to a covariate_model, in harmonizationLearn's layout."""
+    B_hat, alpha, grand_mean, mod_mean, var_pooled = fit_covariates(model, data, penweight)
+    model.update({'B_hat': B_hat,
+                  'stand_mean': np.repeat(grand_mean[:, None], len(data), axis=1),
+                  'mod_mean': mod_mean.T,
+                  'var_pooled': var_pooled[:, None]})
+    if alpha is not None:
+        model['alpha'] = alpha
+    return model
+
+def learn_model(data, covars, smooth_terms=[], eb=True, eb_method="parametric", gam="batched", penweight="feature", icv=None,
+                out=None):
+    """
+    Learns a ComBat model like neuroHarmonize's harmonizationLearn, with the empirical Bayes step
+    run by eb_parametric or eb_nonparametric for all sites and features at once.
+
+    With gam="batched", covariates are fit by fit_covariates; with smooth terms, the GAM is fit for all
+    features at once (penalty weights picked by GCV, per feature or shared according to penweight).
+    gam="statsmodels" runs harmonizationLearn's own fit: one statsmodels GLMGam per feature, with weights
+    picked by randomized k-fold cross-validation.
+
+    The model also keeps the per-site sufficient statistics of the fit (site_stats), from which update_model
+    adds new samples. When covars['ICV_adj'] is ICV adjusted by another model, icv gives the raw ICV of the
+    samples, which the statistics hold in its place.
+
+    Returns the model (same keys as harmonizationLearn's) and the harmonized data, written into out if given.
+    """
+    if eb_method not in ("parametric", "nonparametric"):
+        raise ValueError(f"eb_method must be 'parametric' or 'nonparametric', got {eb_method!r}")
+    if gam not in GAM_BACKENDS:
+        raise ValueError(f"gam must be one of {GAM_BACKENDS}, got {gam!r}")
+    # as in harmonizationLearn, there is nothing to pool over with a single feature
+    eb = eb and data.shape[1] > 1
+
+    # covariate fit without EB, then the standardized data (N_samples x N_features) it implies
+    with stage("fit_covariates", gam=gam if smooth_terms else "linear", features=data.shape[1]):
+        if gam == "batched":
+            model = _fit_design(covariate_model(covars, smooth_terms), data, penweight)
+        else:
+            from neuroHarmonize import harmonizationLearn
+            model, _ = harmonizationLearn(data, covars, eb=False, smooth_terms=smooth_terms)
+    return _learn_site_effects(model, data, site_index(covars, model), eb, eb_method, icv, out)
+
+def _learn_site_effects(model, data, sites, eb, eb_method, icv=None, out=None):
+    """learn_model after the covariate fit: EB site effects, site_stats and the harmonized data."""
+    with stage("eb", eb=eb, eb_method=eb_method):
+        sd = np.sqrt(model['var_pooled'][:, 0])
+        s_data = (data - model['stand_mean'].T - model['mod_mean'].T) / sd
+        n, s1, s2 = site_moments(s_data, sites, len(model['SITE_labels']))
+        LS = fit_location_scale(n, s1, s2, eb=eb)
+
+        if not eb:
+            gamma_star, delta_star = LS['gamma_hat'], LS['delta_hat']
+        elif eb_method == "parametric":
+            gamma_star, delta_star = eb_parametric(n, s1, s2, LS)
+        else:
+            gamma_star, delta_star = eb_nonparametric(s_data, sites, LS)
+
+    model.update(LS)
+    model.update({'gamma_star': gamma_star, 'delta_star': delta_star, 'eb': eb, 'eb_method': eb_method})
+    with stage("site_stats"):
+        model['stats'] = _model_stats(model, model['design'], data, sites, len(model['SITE_labels']), icv)
+
+    with stage("adjust"):
+        return model, adjust(data, s_data, sites, gamma_star, delta_star, sd, out)
+
+def model_features(model, cols):
+    """The part of a model that applies to features cols (a slice), for applying it a chunk of features at a time."""
+    sliced = dict(model)
+    sliced.update({'B_hat': model['B_hat'][:, cols],
+                   'stand_mean': model['stand_mean'][cols],
+                   'var_pooled': model['var_pooled'][cols],
+                   'gamma_star': np.asarray(model['gamma_star'])[:, cols],
+                   'delta_star': np.asarray(model['delta_star'])[:, cols]})
+    return sliced
+
+def learn_model_chunked(data, covars, out, smooth_terms=[], eb=True, rows=None, chunksize=10000):
+    """
+    learn_model for feature matrices too large for memory, such as voxel- or vertex-wise maps memory-mapped
+    with np.load(..., mmap_mode='r'). data (N_samples x N_features) is read chunksize features at a time, twice:
+    once to fit the covariates and sum up each site's moments, once to write the harmonized chunk into out
+    (e.g. a np.lib.format.open_memmap array, whose dtype may be float32). rows selects the samples used
+    from data and written to out (e.g. one stratum).
+
+    Only per-feature parameters and the site moments the EB hyperpriors are computed from are held in memory.
+    EB is parametric, and GAM penalty weights are picked per feature. The model keeps the grand mean
+    (N_features x 1) as stand_mean and no training mod_mean, neither of which apply_model needs.
+    """
+    rows = slice(None) if rows is None else rows
+    n_features = data.shape[1]
+    chunks = [slice(start, min(start + chunksize, n_features)) for start in range(0, n_features, chunksize)]
+    eb = eb and n_features > 1
+
+    model = covariate_model(covars, smooth_terms)
+    design = model['design']
+    n_batch = model['info_dict']['n_batch']
+    sites = site_index(covars, model)
+
+    B_hat = np.empty((design.shape[1], n_features))
+    grand_mean, var_pooled = np.empty(n_features), np.empty(n_features)
+    n, s1, s2 = (np.empty((n_batch, n_features)) for _ in range(3))
+    alphas = []
+    for cols in chunks:
+        x = np.asarray(data[:, cols][rows], dtype=float)
+        B_hat[:, cols], alpha, grand_mean[cols], mod_mean, var_pooled[cols] = fit_covariates(model, x)
+        s_data = (x - grand_mean[cols] - mod_mean) / np.sqrt(var_pooled[cols])
+        n[:, cols], s1[:, cols], s2[:, cols] = site_moments(s_data, sites, n_batch)
+        alphas.append(alpha)
+
+    LS = fit_location_scale(n, s1, s2, eb=eb)
+    if eb:
+        gamma_star, delta_star = eb_parametric(n, s1, s2, LS)
+    else:
+        gamma_star, delta_star = LS['gamma_hat'], LS['delta_hat']
+
+    sd = np.sqrt(var_pooled)
+    for cols in chunks:
+        x = np.asarray(data[:, cols][rows], dtype=float)
+        s_data = (x - grand_mean[cols] - design[:, n_batch:] @ B_hat[n_batch:, cols]) / sd[cols]
+        out[rows, cols] = adjust(x, s_data, sites, gamma_star[:, cols], delta_star[:, cols], sd[cols])
+
+    model.update(LS)
+    model.update({'B_hat': B_hat, 'stand_mean': grand_mean[:, None], 'var_pooled': var_pooled[:, None],
+                  'gamma_star': gamma_star, 'delta_star': delta_star, 'eb': eb})
+    if model['smooth_model']['perform_smoothing']:
+        model['alpha'] = np.hstack(alphas)
+    return model
+
+
+## Two-step ICV->ROI fit on one design
+
+def _icv_adj_column(model):
+    """Position in a model's design of an ICV_adj covariate appended to its covariates: after the other linear ones."""
+    smooth_cols = model['smooth_model']['smooth_cols']
+    return len(model['SITE_labels']) + sum(c != 'SITE' and i not in smooth_cols for i, c in enumerate(model['Covariates']))
+
+def _insert_icv_adj(model, design, icv_adj):
+    """design_matrix(covars with ICV_adj appended, ...) from design = design_matrix(covars, model)."""
+    if not model['smooth_model']['perform_smoothing']:
+        icv_adj = icv_adj.astype(np.float32) # as design_matrix holds Linear covariates
+    return np.insert(design, _icv_adj_column(model), icv_adj, axis=1)
+
+def _roi_step_model(model_icv, icv_adj):
+    """covariate_model(covars with ICV_adj appended, ...) from the ICV step's model, reusing its design and spline basis."""
+    smooth_model = dict(model_icv['smooth_model'])
+    if smooth_model['df_gam'] is not None:
+        df_gam = smooth_model['df_gam'].assign(**{f"c{len(model_icv['Covariates'])}": icv_adj})
+        smooth_model.update({'df_gam': df_gam, 'formula': 'y ~ ' + ' + '.join(df_gam.columns) + ' - 1'})
+    model = {key: model_icv[key] for key in ('SITE_labels', 'SITE_labels_train', 'ref_batch')}
+    model.update({'Covariates': list(model_icv['Covariates']) + ['ICV_adj'], 'info_dict': dict(model_icv['info_dict']),
+                  'smooth_model': smooth_model, 'design': _insert_icv_adj(model_icv, model_icv['design'], icv_adj)})
+    return model
+
+def learn_roi_step(model_icv, icv, icv_adj, rois, eb=True, eb_method="parametric", penweight="feature", out=None):
+    """
+    Second step of a two-step fit: learn_model(rois, covars with ICV_adj appended, ..., icv=icv) given the first,
+    model_icv = learn_model(ICV, covars, ...) with the batched backend, without building the covariates again:
+    the ROI design is the ICV design (spline basis included) with the ICV_adj column inserted.
+
+    Returns the ROI model and the harmonized ROIs, written into out if given.
+    """
+    eb = eb and rois.shape[1] > 1
+    n_batch = len(model_icv['SITE_labels'])
+    with stage("fit_covariates", gam="batched" if model_icv['smooth_model']['perform_smoothing'] else "linear",
+               features=rois.shape[1]):
+        model = _fit_design(_roi_step_model(model_icv, icv_adj), rois, penweight)
+    return _learn_site_effects(model, rois, model['design'][:, :n_batch].argmax(axis=1), eb, eb_method, icv, out)
+
+def learn_two_step(icv, rois, covars, smooth_terms=[], eb=True, eb_method="parametric", penweight="feature", out=None):
+    """
+    Fused two-step ICV->ROI fit with the batched backend: ICV is fit as a single feature (without EB), then the
+    ROIs by learn_roi_step on the same design with the adjusted ICV as a covariate. covars holds the covariates
+    of both steps but ICV_adj.
+
+    Returns the (ICV model, ROI model) pair and the harmonized [ICV, ROIs] (N_samples x (1 + N_ROIs)),
+    written into out if given.
+    """
+    if out is None:
+        out = np.empty((len(icv), 1 + rois.shape[1]))
+    model_icv, _ = learn_model(icv[:, None], covars, smooth_terms, eb=False, penweight=penweight, out=out[:, :1])
+    model_rois, _ = learn_roi_step(model_icv, icv, out[:, 0], rois, eb, eb_method, penweight, out=out[:, 1:])
+    return (model_icv, model_rois), out
+
+def apply_two_step(icv, rois, covars, models, out=None):
+    """
+    Applies an (ICV model, ROI model) pair as apply_model would step by step, building the covariates' design rows
+    once: the ROI step's are the ICV step's with the adjusted ICV inserted. covars holds the covariates of both
+    steps but ICV_adj. ICV models fit on ICV stacked twice (two identical features) apply as well.
+
+    Returns the harmonized [ICV, ROIs] (N_samples x (1 + N_ROIs)), written into out if given.
+    """
+    model_icv, model_rois = models
+    if list(model_rois['Covariates']) != list(model_icv['Covariates']) + ['ICV_adj'] \
+            or list(model_rois['SITE_labels']) != list(model_icv['SITE_labels']):
+        raise ValueError("the ROI model must share the ICV model's sites and covariates, plus ICV_adj")
+    if out is None:
+        out = np.empty((len(icv), 1 + rois.shape[1]))
+    design = design_matrix(covars, model_icv)
+    sites = site_index(covars, model_icv)
+    with stage("apply_ICV", samples=len(icv)):
+        _apply_design(np.asarray(icv, dtype=float)[:, None], design, sites, model_features(model_icv, slice(0, 1)), out[:, :1])
+    with stage("apply_ROIs", samples=len(rois), features=rois.shape[1]):
+        _apply_design(np.asarray(rois, dtype=float), _insert_icv_adj(model_icv, design, out[:, 0]), sites, model_rois, out[:, 1:])
+    return out
+
+
+## Model updates from sufficient statistics
+
+def site_stats(x, data, sites, n_batch, weights=None):
+    """
+    Per-site sufficient statistics of a fit of data (N_samples x N_features) on the covariate columns x of a design
+    (N_samples x N_covariates, without the site columns). With v = [1, x]: gram holds the sums of v v'
+    (N_sites x (1 + N_covariates) x (1 + N_covariates)), cross the sums of v y' (N_sites x (1 + N_covariates) x N_features)
+    and sq the sums of y^2 (N_sites x N_features). Summed over sites, they give the design's cross-products.
+    weights optionally counts each sample that many times (e.g. bootstrap draws).
+    """
+    v = np.column_stack([np.ones(len(x)), x])
+    if weights is not None:
+        data = data * np.sqrt(weights)[:, None]
+        v = v * np.sqrt(weights)[:, None]
+    stats = {'gram': np.zeros((n_batch, v.shape[1], v.shape[1])),
+             'cross': np.zeros((n_batch, v.shape[1], data.shape[1])),
+             'sq': np.zeros((n_batch, data.shape[1])),
+             'icv_col': None}
+    for i in range(n_batch):
+        rows = sites == i
+        stats['gram'][i] = v[rows].T @ v[rows]
+        stats['cross'][i] = v[rows].T @ data[rows]
+        stats['sq'][i] = (data[rows] ** 2).sum(axis=0)
+    return stats
+
+def _model_stats(model, design, data, sites, n_sites, icv=None):
+    """site_stats of samples on a model's design, with raw ICV in place of the ICV_adj covariate if icv is given."""
+    x = design[:, len(model['SITE_labels']):].copy()
+    icv_col = None
+    if icv is not None:
+        smooth_terms = model['smooth_model']['smooth_terms']
+        icv_col = [c for c in model['Covariates'] if c != 'SITE' and c not in smooth_terms].index('ICV_adj')
+        x[:, icv_col] = icv
+    stats = site_stats(x, data, sites, n_sites)
+    stats['icv_col'] = icv_col
+    return stats
+
+def add_stats(stats, sites, new_stats, new_sites):
+    """Sums site_stats over the site labels sites and new_sites; returns the sums over the sorted union of both."""
+    all_sites = np.union1d(sites, new_sites)
+    total = {key: np.zeros((len(all_sites),) + stats[key].shape[1:]) for key in ('gram', 'cross', 'sq')}
+    for part, labels in ((stats, sites), (new_stats, new_sites)):
+        positions = np.searchsorted(all_sites, labels)
+        for key in total:
+            total[key][positions] += part[key]
+    total['icv_col'] = stats['icv_col']
+    return total, all_sites
+
+def _icv_adjusted_stats(stats, icv_model):
+    """
+    Turns site_stats holding raw ICV in covariate column stats['icv_col'] into those of ICV_adj: within a site,
+    icv_model's adjustment is affine in ICV and the other covariates, ICV_adj = a ICV + x'b + c.
+    """
+    n_batch = len(icv_model['SITE_labels'])
+    scale = 1 / np.sqrt(np.asarray(icv_model['delta_star'])[:, 0])
+    gamma = np.asarray(icv_model['gamma_star'])[:, 0]
+    grand_mean = icv_model['stand_mean'][0, 0]
+    sd = np.sqrt(icv_model['var_pooled'][0, 0])
+
+    # maps v = [1, x with raw ICV] to [1, x with ICV_adj], one matrix per site
+    row = 1 + stats['icv_col']
+    others = [j for j in range(1, stats['gram'].shape[1]) if j != row]
+    M = np.tile(np.eye(stats['gram'].shape[1]), (n_batch, 1, 1))
+    M[:, row, row] = scale
+    M[:, row, others] = -np.outer(scale - 1, icv_model['B_hat'][n_batch:, 0])
+    M[:, row, 0] = -grand_mean * (scale - 1) - gamma * sd * scale
+    return {'gram': M @ stats['gram'] @ M.transpose(0, 2, 1), 'cross': M @ stats['cross'], 'sq': stats['sq'], 'icv_col': None}
+
+def _stats_info(sites, counts):
+    """Site bookkeeping (info_dict) of a model fit from site_stats, with counts the (weighted) samples per site."""
+    return {'batch_levels': np.arange(len(sites)), 'n_batch': len(sites), 'n_sample': counts.sum(),
+            'sample_per_batch': counts, 'batch_info': None, 'ref_level': None}
+
+def fit_stats(model, stats, eb=True, penweight="feature", alpha=None, init=None):
+    """
+    Fits a model from site_stats in the layout of its design (SITE_labels, covariates and any spline basis), as
+    learn_model would from the samples behind them, with parametric EB estimates if eb. The grand mean is kept
+    as stand_mean (N_features x 1); training-sized arrays (design, mod_mean) are not formed.
+
+    To refit from statistics close to those of an earlier fit (e.g. resamples of its samples), alpha can hold
+    the GAM penalty weights to keep (solve_gam, no GCV search) and init the (gamma, delta) to start EB from.
+    """
+    gram, cross, sq = stats['gram'], stats['cross'], stats['sq']
+    n_batch = len(model['SITE_labels'])
+    counts = gram[:, 0, 0]
+    n_sample = counts.sum()
+    xtx = np.block([[np.diag(counts), gram[:, 0, 1:]], [gram[:, 0, 1:].T, gram[:, 1:, 1:].sum(axis=0)]])
+    xty = np.vstack([cross[:, 0], cross[:, 1:].sum(axis=0)])
+    yty = sq.sum(axis=0)
+
+    bs = model['smooth_model']['bsplines_constructor']
+    if bs is not None:
+        k_linear = xtx.shape[0] - sum(pen.shape[0] for pen in bs.penalty_matrices)
+        if alpha is None:
+            B_hat, alpha = fit_gam(xtx, xty, yty, n_sample, bs, k_linear, penweight=penweight)
+        else:
+            B_hat = solve_gam(xtx, xty, bs, k_linear, alpha)
+        model['alpha'] = alpha
+    else:
+        B_hat = least_squares(xtx, xty)
+    grand_mean = counts / n_sample @ B_hat[:n_batch]
+    var_pooled = (yty - 2 * (B_hat * xty).sum(axis=0) + (B_hat * (xtx @ B_hat)).sum(axis=0)) / n_sample
+
+    # per-site sums and sums of squares of the standardized data, (y + v'W) / sd with v = [1, x]
+    W = np.vstack([-grand_mean, -B_hat[n_batch:]])
+    s1 = (cross[:, 0] + gram[:, 0] @ W) / np.sqrt(var_pooled)
+    s2 = (sq + 2 * (W * cross).sum(axis=1) + np.einsum('qf,iqr,rf->if', W, gram, W)) / var_pooled
+    n = np.repeat(counts[:, None], len(grand_mean), axis=1)
+
+    LS = fit_location_scale(n, s1, s2, eb=eb)
+    if eb:
+        gamma_star, delta_star = eb_parametric(n, s1, s2, LS, init=init)
+    else:
+        gamma_star, delta_star = LS['gamma_hat'], LS['delta_hat']
+
+    model.update(LS)
+    model.update({'B_hat': B_hat, 'stand_mean': grand_mean[:, None], 'var_pooled': var_pooled[:, None],
+                  'gamma_star': gamma_star, 'delta_star': delta_star, 'eb': eb})
+    return model
+
+def resample_model(model, stats, keep=None, icv_model=None, warm_start=True, penweight="feature"):
+    """
+    Refits a model from learn_model on other site_stats in its design's layout: those of resampled training
+    samples (e.g. bootstrap draws, as site_stats weights), or its own with only the sites where keep (a boolean
+    mask over SITE_labels) is True, e.g. leaving one site out. For the ROI model of a two-step fit, whose
+    statistics hold raw ICV, icv_model is the ICV model refit on the same samples.
+
+    With warm_start, the GAM penalty weights of the model are kept and EB starts from its estimates: much
+    cheaper than picking them again, and resamples are then conditional on the chosen smoothness.
+    EB estimates are parametric.
+    """
+    if keep is None:
+        keep = np.ones(len(model['SITE_labels']), dtype=bool)
+    sites = np.asarray(model['SITE_labels'])[keep]
+    icv_col = stats['icv_col']
+    stats = {key: stats[key][keep] for key in ('gram', 'cross', 'sq')}
+    stats['icv_col'] = icv_col
+
+    counts = stats['gram'][:, 0, 0]
+    refit = {key: value for key, value in model.items() if key not in ('design', 'mod_mean', 'stats')}
+    refit.update({'SITE_labels': sites, 'SITE_labels_train': sites,
+                  'info_dict': _stats_info(sites, counts),
+                  'smooth_model': dict(model['smooth_model'], df_gam=None)})
+    if icv_model is not None:
+        if list(icv_model['SITE_labels']) != list(sites):
+            raise ValueError("icv_model must be refit on the same samples first")
+        stats = _icv_adjusted_stats(stats, icv_model)
+    alpha, init = None, None
+    if warm_start:
+        alpha = model.get('alpha')
+        init = (np.asarray(model['gamma_star'])[keep], np.asarray(model['delta_star'])[keep])
+    return fit_stats(refit, stats, eb=model['eb'], penweight=penweight, alpha=alpha, init=init)
+
+def update_model(model, data, covars, penweight="feature", icv=None, icv_model=None):
+    """
+    Adds samples (data, N_new x N_features, and covars holding the model's covariates) to a model from learn_model
+    without its training data, by adding their site_stats to the model's and refitting from the sums.
+    Samples may come from sites the model has not seen.
+
+    A Linear model becomes the one learn_model would fit on all samples, and a GAM the one it would fit with
+    the model's spline basis held fixed (penalty weights are picked again by GCV). EB estimates are parametric.
+    The ROI model of a two-step fit holds raw ICV in its statistics (see learn_model), since the training
+    samples' ICV_adj moves with the ICV model: icv is then the new samples' raw ICV, and icv_model the updated
+    ICV model. (In Linear designs neuroCombat rounds ICV_adj to float32, so there the update agrees with a refit
+    to that precision.)
+
+    Returns the updated model and the new samples harmonized by it.
+    """
+    if 'stats' not in model:
+        raise ValueError("the model has no sufficient statistics to update from; learn it again with learn_model")
+    if model.get('eb_method', "parametric") != "parametric":
+        raise ValueError("only models with parametric empirical Bayes estimates can be updated")
+    if (model['stats']['icv_col'] is None) != (icv_model is None):
+        raise ValueError("icv and icv_model are needed exactly for models whose statistics hold raw ICV")
+
+    new_sites = np.unique(covars.SITE)
+    new_stats = _model_stats(model, design_matrix(covars, model), data, np.searchsorted(new_sites, covars.SITE),
+                             len(new_sites), icv)
+    stats, sites = add_stats(model['stats'], model['SITE_labels'], new_stats, new_sites)
+
+    counts = stats['gram'][:, 0, 0].astype(int)
+    updated = {key: value for key, value in model.items() if key not in ('design', 'mod_mean')}
+    updated.update({'SITE_labels': sites, 'SITE_labels_train': sites, 'stats': stats,
+                    'info_dict': _stats_info(sites, counts),
+                    'smooth_model': dict(model['smooth_model'], df_gam=None)})
+    if icv_model is not None:
+        if list(icv_model['SITE_labels']) != list(sites):
+            raise ValueError("icv_model must be updated with the same samples first")
+        stats = _icv_adjusted_stats(stats, icv_model)
+    fit_stats(updated, stats, eb=model['eb'], penweight=penweight)
+    return updated, apply_model(data, covars, updated)
@@ -0,0 +1,93 @@
+import os
+import shutil
+import pandas as pd
+from pipeline_trace import traced
+
+# file extension for each storage format of the tables in data/deriv
+FORMATS = {"csv": ".csv", "parquet": ".parquet"}
+
+
+def _is_parquet(path):
+    return path.endswith(".parquet") or os.path.isdir(path) # partitioned datasets are directories
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The parquet format needs pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+def deriv_path(data_dir, stem, fmt="csv"):
+    """data/deriv/{stem}.csv or data/deriv/{stem}.parquet"""
+    if fmt not in FORMATS:
+        raise ValueError(f"fmt must be one of {tuple(FORMATS)}, got {fmt!r}")
+    return os.path.join(data_dir, stem + FORMATS[fmt])
+
+def deriv_stem(path):
+    """data/deriv/HC_data.parquet -> HC_data"""
+    return os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+
+def deriv_columns(path):
+    """Column names of a table without reading its rows."""
+    if _is_parquet(path):
+        return _pyarrow().dataset.dataset(path, partitioning="hive").schema.names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+@traced
+def read_deriv(path, columns=None):
+    """
+    Reads a table from data/deriv as a DataFrame, from CSV or Parquet depending on path.
+    Parquet keeps the ROI volumes as binary float64 columns, so nothing is parsed from text.
+    """
+    if _is_parquet(path):
+        _pyarrow()
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+def iter_deriv(path, chunksize):
+    """Yields a table chunksize rows at a time."""
+    if _is_parquet(path):
+        pa = _pyarrow()
+        for batch in pa.dataset.dataset(path, partitioning="hive").to_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize)
+
+@traced
+def write_deriv(data, path, partition_cols=None):
+    """
+    Writes a table to data/deriv as CSV or Parquet depending on path.
+    With partition_cols (Parquet only), writes one dataset directory split by those columns in a single pass.
+    """
+    if _is_parquet(path):
+        _pyarrow()
+        if partition_cols is not None and os.path.isdir(path):
+            shutil.rmtree(path) # otherwise the new partitions are added to the old ones
+        data.to_parquet(path, index=False, partition_cols=partition_cols)
+    elif partition_cols is not None:
+        raise ValueError("partitioned datasets need the parquet format")
+    else:
+        data.to_csv(path, index=False)
+
+@traced
+def write_deriv_chunks(chunks, path):
+    """Writes an iterable of DataFrames to one table, appending each chunk as it arrives."""
+    if _is_parquet(path):
+        pa = _pyarrow()
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pa.parquet.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        header = True
+        for chunk in chunks:
+            chunk.to_csv(path, mode='w' if header else 'a', header=header, index=False)
+            header = False
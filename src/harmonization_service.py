@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import queue
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+from stratified_ComBat import apply_strata, load_models, model_path, read_manifest, covars_by_sex, DEMOGRAPHICS
+from model_artifact import artifact_path
+
+# Specify directories
+PROJECT_ROOT = "/Users/vgonzenb/PennSIVE/MSKIDS/"
+MODELS_DIR = os.path.join("results", "models")
+
+
+class ModelCache:
+    """
+    The ICV and ROI models of each stratum, loaded once and kept in memory.
+
+    Every poll seconds at most, the manifest save_models writes last is checked, and the models are loaded again
+    if it changed, e.g. after update_ComBat_by_sex.py. Models are replaced only by a whole set whose manifest is
+    the same before and after loading it, so a reload never pairs models from two saves; while a set is being
+    saved (no manifest) or cannot be read, the old models are kept. For sets saved without a manifest, the
+    modification times of the models (artifact headers, which are written last, or pickles) are checked instead.
+    """
+
+    def __init__(self, models_dir, mod, ref, eb, keys, poll=1.0):
+        self.models_dir, self.mod, self.ref, self.eb, self.keys = models_dir, mod, ref, eb, keys
+        self.poll = poll
+        self.versioned = read_manifest(models_dir, mod, ref, eb) is not None
+        self.version = self._version()
+        self.models = load_models(models_dir, mod, ref, eb, keys)
+        self.checked = time.monotonic()
+        self.loaded = time.time()
+
+    def _version(self):
+        if self.versioned:
+            return read_manifest(self.models_dir, self.mod, self.ref, self.eb)
+        stamp = []
+        for key in self.keys:
+            for step in ("ICV", "ROIs"):
+                path = model_path(self.models_dir, self.mod, step, self.ref, key, self.eb)
+                for candidate in (os.path.join(artifact_path(path), 'header.json'), path):
+                    if os.path.exists(candidate):
+                        stamp.append(os.stat(candidate).st_mtime_ns)
+                        break
+        return stamp
+
+    def get(self):
+        if time.monotonic() - self.checked > self.poll:
+            self.checked = time.monotonic()
+            version = self._version()
+            if version is not None and version != self.version:
+                try:
+                    models = load_models(self.models_dir, self.mod, self.ref, self.eb, self.keys)
+                except Exception: # caught mid-save (e.g. a truncated pickle): keep serving the old models
+                    return self.models
+                if self._version() == version:
+                    self.models, self.version, self.loaded = models, version, time.time()
+        return self.models
+
+    def features(self):
+        """Names of the ICV and ROI columns the models were learned on, or None for models saved without them."""
+        model_icv, model_rois = next(iter(self.models.values()))
+        if 'features' not in model_icv or 'features' not in model_rois:
+            return None
+        return model_icv['features'][0], list(model_rois['features'])
+
+
+class MicroBatcher:
+    """
+    Collects scans from concurrent requests and harmonizes them together: a single worker thread waits up to
+    max_wait seconds (or until max_batch scans are queued) and runs one apply_strata call per set of columns.
+    Every request is answered: with its rows, the error that failed it, or a TimeoutError after timeout seconds.
+    """
+
+    def __init__(self, cache, covars_fn, strata, max_batch=256, max_wait=0.005, timeout=60.0):
+        self.cache, self.covars_fn, self.strata = cache, covars_fn, strata
+        self.max_batch, self.max_wait, self.timeout = max_batch, max_wait, timeout
+        self.requests = queue.Queue()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, data):
+        """Harmonizes a DataFrame of scans; blocks until its batch is done and returns the adjusted rows."""
+        request = {'data': self._select(data), 'done': threading.Event(), 'result': None, 'error': None}
+        self.requests.put(request)
+        if not request['done'].wait(self.timeout):
+            raise TimeoutError(f"scans not harmonized within {self.timeout} s")
+        if request['error'] is not None:
+            raise request['error']
+        return request['result'][data.columns]
+
+    def _select(self, data):
+        """
+        data with its feature columns in the order of the models' training table, picked by name; scans missing
+        any of the models' features or holding others are refused. Models saved without feature names take
+        the columns after the demographics by position, as the apply scripts do.
+        """
+        features = self.cache.features()
+        if features is None:
+            return data
+        names = [features[0]] + features[1]
+        missing = [c for c in names if c not in data.columns]
+        unknown = [c for c in data.columns if c not in DEMOGRAPHICS and c not in names]
+        if missing or unknown:
+            raise ValueError(f"scans must have the models' features: missing {missing}, unknown {unknown}")
+        return data[[c for c in data.columns if c in DEMOGRAPHICS] + names]
+
+    def _work(self):
+        while True:
+            batch = [self.requests.get()]
+            n_rows = len(batch[0]['data'])
+            deadline = time.monotonic() + self.max_wait
+            while n_rows < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+                n_rows += len(batch[-1]['data'])
+
+            try:
+                # scans are stacked per set of demographic columns (features come in the models' order)
+                groups = {}
+                for request in batch:
+                    groups.setdefault(tuple(request['data'].columns), []).append(request)
+                models = self.cache.get()
+                for requests in groups.values():
+                    self._apply(requests, models)
+            except Exception as error: # fail the batch, not the worker
+                for request in batch:
+                    if not request['done'].is_set():
+                        request['error'] = error
+                        request['done'].set()
+
+    def _apply(self, requests, models):
+        try:
+            data = pd.concat([request['data'] for request in requests], ignore_index=True)
+            data_adj = apply_strata(data, models, self.covars_fn, self.strata, self.cache.mod, n_jobs=1)
+            start = 0
+            for request in requests:
+                request['result'] = data_adj.iloc[start:start + len(request['data'])]
+                start += len(request['data'])
+        except Exception as error:
+            if len(requests) > 1: # find the request at fault, without failing the others
+                for request in requests:
+                    self._apply([request], models)
+                return
+            requests[0]['error'] = error
+        for request in requests:
+            request['done'].set()
+
+
+class HarmonizationHandler(BaseHTTPRequestHandler):
+    """
+    POST /harmonize with a JSON list of scans (or {"rows": [...]}), each an object with the columns of the
+    data/deriv tables: site, age, sex, ICV and the ROIs, named as in the models' training table. Returns the same
+    rows adjusted.
+    GET /health describes the loaded models.
+    """
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send(404, {'error': f'no such path {self.path}'})
+        cache = self.server.batcher.cache
+        self._send(200, {'mod': cache.mod, 'ref': cache.ref, 'eb': cache.eb, 'strata': [str(k) for k in cache.keys],
+                         'loaded': cache.loaded})
+
+    def do_POST(self):
+        if self.path != '/harmonize':
+            return self._send(404, {'error': f'no such path {self.path}'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            rows = body['rows'] if isinstance(body, dict) else body
+            data = pd.DataFrame.from_records(rows)
+        except (ValueError, KeyError, TypeError) as error:
+            return self._send(400, {'error': f'could not read scans: {error}'})
+        if data.empty:
+            return self._send(400, {'error': 'no scans'})
+        try:
+            data_adj = self.server.batcher.submit(data)
+        except (ValueError, KeyError, TypeError) as error: # scans the models cannot take
+            return self._send(400, {'error': str(error)})
+        except Exception as error: # anything else still gets a response
+            return self._send(500, {'error': f'{type(error).__name__}: {error}'})
+        # NaN (scans from sites the models have not seen) as null
+        self._send(200, {'rows': data_adj.astype(object).where(data_adj.notna(), None).to_dict(orient='records')})
+
+    def log_message(self, format, *args):
+        pass # one line per scan would drown the service's output
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("local", 0) # BaseHTTPRequestHandler expects a (host, port) client address
+
+
+def serve_harmonization(mod="GAM", ref="HC_data", eb=True, host="127.0.0.1", port=8050, socket_path=None,
+                        max_batch=256, max_wait=0.005):
+    """
+    Serves the ComBat models learned from Healthy Controls separately for males and females over HTTP on host:port,
+    or on the Unix socket socket_path if given, e.g.
+
+        curl -s localhost:8050/harmonize -d '[{"ID": "x", "site": "CHP", "age": 12.5, "sex": "MALE", "DLICV": ..., ...}]'
+    """
+    cache = ModelCache(PROJECT_ROOT + MODELS_DIR, mod, ref, eb, keys=("MALE", "FEMALE"))
+    batcher = MicroBatcher(cache, covars_by_sex, "sex", max_batch, max_wait)
+
+    if socket_path is None:
+        server = ThreadingHTTPServer((host, port), HarmonizationHandler)
+    else:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, HarmonizationHandler)
+    server.batcher = batcher
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+if __name__ == "__main__":
+    serve_harmonization(mod="Linear")
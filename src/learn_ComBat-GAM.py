@@ -1,65 +1,32 @@
 import os
-import numpy as np
-import pandas as pd
-from neuroHarmonize import harmonizationLearn
-import pickle
+from model_store import ModelStore
+from deriv_store import read_deriv, write_deriv, deriv_path, deriv_stem
+from stratified_ComBat import learn_strata, save_models, covars_with_sex
+from pipeline_trace import traced
 
 PROJECT_ROOT = "/Users/vgonzenb/PennSIVE/MSKIDS/"
 MODELS_DIR = os.path.join("results", "models")
 DATA_DIR = os.path.join("data", "deriv")
+CACHE_DIR = os.path.join("results", "cache")
 
 
-def harmonize_data(data_file = 'HC_data.csv', mod="GAM", eb=True):
+@traced
+def harmonize_data(data_file = 'HC_data.csv', mod="GAM", eb=True, cache=True, fmt="csv", gam="batched"):
 
-    data = pd.read_csv(os.path.join(PROJECT_ROOT + DATA_DIR, data_file))
+    data = read_deriv(os.path.join(PROJECT_ROOT + DATA_DIR, data_file))
+    data_name = deriv_stem(data_file)
 
-    # Prepare covariates
-    covars = data.iloc[:, 2:4] # select site, age and sex
-    covars.columns = ['SITE', 'AGE']
-    covars = covars.join(pd.get_dummies(data.sex))
+    # reuse fits of unchanged inputs from previous runs
+    store = ModelStore(PROJECT_ROOT + CACHE_DIR) if cache else None
 
-    # Prepare data for harmonization Step 1
-    icv = np.array(data.iloc[:, 5])
+    # Run harmonization Steps 1 and 2 on all data (sex is a covariate)
+    models, data_adj = learn_strata(data, covars_with_sex, mod=mod, eb=eb, store=store, gam=gam)
 
-    # Run harmonization Step 1
-    if mod == "GAM":
-        mod_ICV, ICV_adj = harmonizationLearn(np.stack((icv, icv)).T, covars, smooth_terms=['AGE'], eb=False) # stack ICV to fit dimensions required by harmonizationLearn
-    elif mod == "Linear":
-        mod_ICV, ICV_adj = harmonizationLearn(np.stack((icv, icv)).T, covars, eb=False) # stack ICV to fit dimensions required by harmonizationLearn
-    else:
-        print("Please specify a type of model")
-        return None
-    # prep data for step 2
-    covars['ICV_adj'] = ICV_adj[:, 0]
-
-    ROIs = np.array(data.iloc[:, -145:])
-
-    # run  harmonization Step 2
-    if mod == "GAM":
-        mod_ROIs, ROIs_adj = harmonizationLearn(ROIs, covars, smooth_terms=['AGE'], eb=eb) 
-    elif mod == "Linear":
-        mod_ROIs, ROIs_adj = harmonizationLearn(ROIs, covars, eb=eb) 
-    
-    # join data into DataFrame
-    data_adj = pd.concat([data.iloc[:, :5],
-                          pd.DataFrame(ICV_adj[:, 0], 
-                                       index=data.index, 
-                                       columns=[data.columns[5]]
-                                       ),
-
-                          pd.DataFrame(ROIs_adj, 
-                                       index=data.index,
-                                       columns=data.columns[-145:]
-                                       )
-                          ], axis=1)
-
-    # save adjusted DataFrame as .csv
-    data_adj.to_csv(os.path.join(PROJECT_ROOT + DATA_DIR, f'{data_file[:-4]}_adj_ComBat-{mod}_split-None_eb-{eb}.csv'), index=False)
+    # save adjusted DataFrame as .csv or .parquet
+    write_deriv(data_adj, deriv_path(PROJECT_ROOT + DATA_DIR, f'{data_name}_adj_ComBat-{mod}_split-None_eb-{eb}', fmt))
 
     # save models for later use
-    with open(os.path.join(PROJECT_ROOT + MODELS_DIR, f'ComBat-{mod}_ICV_from-{data_file[:-4]}_eb-{eb}.pickle'), mode = 'wb') as file:
-        pickle.dump(mod_ICV, file)
-    with open(os.path.join(PROJECT_ROOT + MODELS_DIR, f'ComBat-{mod}_ROIs_from-{data_file[:-4]}_eb-{eb}.pickle'), mode = 'wb') as file:
-        pickle.dump(mod_ROIs, file)    
+    save_models(models, PROJECT_ROOT + MODELS_DIR, mod, data_name, eb)
 
-harmonize_data()
\ No newline at end of file
+if __name__ == "__main__":
+    harmonize_data()
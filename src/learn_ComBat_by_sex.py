@@ -1,95 +1,32 @@
 import os
-import numpy as np
-import pandas as pd
-from neuroHarmonize import harmonizationLearn
-import pickle
+from model_store import ModelStore
+from deriv_store import read_deriv, write_deriv, deriv_path, deriv_stem
+from stratified_ComBat import learn_strata, save_models, covars_by_sex
+from pipeline_trace import traced
 
 PROJECT_ROOT = "/Users/vgonzenb/PennSIVE/MSKIDS/"
 MODELS_DIR = os.path.join("results", "models")
 DATA_DIR = os.path.join("data", "deriv")
+CACHE_DIR = os.path.join("results", "cache")
 
 
-def harmonize_data_by_sex(data_file = 'HC_data.csv', mod="GAM", eb=True):
-    # Load and split data by sex
-    data = pd.read_csv(os.path.join(PROJECT_ROOT + DATA_DIR, data_file))
-    data_M = data[data.sex == "MALE"]
-    data_F = data[data.sex == "FEMALE"]
+@traced
+def harmonize_data_by_sex(data_file = 'HC_data.csv', mod="GAM", eb=True, n_jobs=None, cache=True, fmt="csv", gam="batched"):
+    # Load data (.csv or .parquet)
+    data = read_deriv(os.path.join(PROJECT_ROOT + DATA_DIR, data_file))
+    data_name = deriv_stem(data_file)
 
-    # Prepare covariates
-    covars_M = data_M.iloc[:, 2:4] # select site and age
-    covars_M.columns = ['SITE', 'AGE']
-    covars_F = data_F.iloc[:, 2:4] # select site and age
-    covars_F.columns = ['SITE', 'AGE']
+    # reuse fits of unchanged inputs from previous runs
+    store = ModelStore(PROJECT_ROOT + CACHE_DIR) if cache else None
 
-    # Prepare data for harmonization Step 1
-    icv_M = np.array(data_M.iloc[:, 5])
-    icv_F = np.array(data_F.iloc[:, 5])
+    # Run harmonization Steps 1 and 2 for males and females in parallel
+    models, data_adj = learn_strata(data, covars_by_sex, strata="sex", mod=mod, eb=eb, n_jobs=n_jobs, store=store, gam=gam)
 
-    # Run harmonization Step 1
-    if mod == "GAM":
-        mod_icv_M, icv_M_adj = harmonizationLearn(np.stack((icv_M, icv_M)).T, covars_M, smooth_terms=['AGE'], eb=False) # stack ICV to fit dimensions required by harmonizationLearn
-        mod_icv_F, icv_F_adj = harmonizationLearn(np.stack((icv_F, icv_F)).T, covars_F, smooth_terms=['AGE'], eb=False) 
-    elif mod == "Linear":
-        covars_M["AGE_SQUARED"] = (covars_M.AGE - covars_M.AGE.mean()) ** 2 # center before squaring (second moment)
-        covars_F["AGE_SQUARED"] = (covars_F.AGE - covars_F.AGE.mean()) ** 2
-
-        mod_icv_M, icv_M_adj = harmonizationLearn(np.stack((icv_M, icv_M)).T, covars_M, eb=False) # stack ICV to fit dimensions required by harmonizationLearn
-        mod_icv_F, icv_F_adj = harmonizationLearn(np.stack((icv_F, icv_F)).T, covars_F, eb=False) 
-    else:
-        print("Please specify a type of model")
-        return None
-
-    # prep data for step 2
-    covars_M['ICV_adj'] = icv_M_adj[:, 0]
-    covars_F['ICV_adj'] = icv_F_adj[:, 0]
-
-    rois_M = np.array(data_M.iloc[:, -145:])
-    rois_F = np.array(data_F.iloc[:, -145:])
-
-    # run  harmonization Step 2
-    if mod == "GAM":
-        mod_rois_M, rois_M_adj = harmonizationLearn(rois_M, covars_M, smooth_terms=['AGE'], eb=eb) 
-        mod_rois_F, rois_F_adj = harmonizationLearn(rois_F, covars_F, smooth_terms=['AGE'], eb=eb)
-    elif mod == "Linear":
-        mod_rois_M, rois_M_adj = harmonizationLearn(rois_M, covars_M, eb=eb) 
-        mod_rois_F, rois_F_adj = harmonizationLearn(rois_F, covars_F, eb=eb)
-
-    # join data into DataFrame
-    data_M_adj = pd.concat([data_M.iloc[:, :5],
-                            pd.DataFrame(icv_M_adj[:, 0], 
-                                         index=data_M.index, 
-                                         columns=[data_M.columns[5]]
-                                         ),
-                            pd.DataFrame(rois_M_adj, 
-                                         index=data_M.index,
-                                         columns=data_M.columns[-145:]
-                                         )
-                            ], axis=1)
-
-    data_F_adj = pd.concat([data_F.iloc[:, :5],
-                            pd.DataFrame(icv_F_adj[:, 0], 
-                                         index=data_F.index, 
-                                         columns=[data_F.columns[5]]
-                                         ),
-                            pd.DataFrame(rois_F_adj, 
-                                         index=data_F.index,
-                                         columns=data_F.columns[-145:]
-                                         )
-                            ], axis=1)
-
-    data_adj = pd.concat([data_M_adj, data_F_adj], axis=0).sort_index()
-
-    # save adjusted DataFrame as .csv
-    data_adj.to_csv(os.path.join(PROJECT_ROOT + DATA_DIR, f'{data_file[:-4]}_adj_ComBat-{mod}_split-MF_eb-{eb}.csv'), index=False)
+    # save adjusted DataFrame as .csv or .parquet
+    write_deriv(data_adj, deriv_path(PROJECT_ROOT + DATA_DIR, f'{data_name}_adj_ComBat-{mod}_split-MF_eb-{eb}', fmt))
 
     # save models for later use
-    with open(os.path.join(PROJECT_ROOT + MODELS_DIR, f'ComBat-{mod}_ICV_from-{data_file[:-4]}_MALE_eb-{eb}.pickle'), mode = 'wb') as file:
-        pickle.dump(mod_icv_M, file)
-    with open(os.path.join(PROJECT_ROOT + MODELS_DIR, f'ComBat-{mod}_ICV_from-{data_file[:-4]}_FEMALE_eb-{eb}.pickle'), mode = 'wb') as file:
-        pickle.dump(mod_icv_F, file)
-    with open(os.path.join(PROJECT_ROOT + MODELS_DIR, f'ComBat-{mod}_ROIs_from-{data_file[:-4]}_MALE_eb-{eb}.pickle'), mode = 'wb') as file:
-        pickle.dump(mod_rois_M, file)    
-    with open(os.path.join(PROJECT_ROOT + MODELS_DIR, f'ComBat-{mod}_ROIs_from-{data_file[:-4]}_FEMALE_eb-{eb}.pickle'), mode = 'wb') as file:
-        pickle.dump(mod_rois_F, file)
+    save_models(models, PROJECT_ROOT + MODELS_DIR, mod, data_name, eb)
 
-harmonize_data_by_sex(mod="Linear")
\ No newline at end of file
+if __name__ == "__main__":
+    harmonize_data_by_sex(mod="Linear")
@@ -0,0 +1,104 @@
+import os
+import numpy as np
+import pandas as pd
+from match_obs import match_obs
+from deriv_store import write_deriv, deriv_path
+from pipeline_trace import traced
+
+# Specify directories
+PROJECT_ROOT = "/Users/vgonzenb/PennSIVE/MSKIDS/"
+BASE_DIR = os.path.join("data", "base")
+DATA_DIR = os.path.join("data", "deriv")
+
+MSK_INVENTORY = "Copy of MSKIDS MRI Inventory Penn_10272020.xlsx"
+MSK_VOLUMES = "MSKIDS_3.5D_2020_DLICV_N4N4_MUSE_Features_DerivedVolumes.csv"
+PNC_DEMOGRAPHICS = os.path.join("PNC", "demographics_from_20160207_dataRelease_update20161114.csv")
+PNC_VOLUMES = os.path.join("PNC", "GO-BBL_muse_dramms+ants_C1.2_Features_DerivedVolumes.csv")
+PNC_LTN_EXCLUDE = os.path.join("PNC", "healthexclude_ltn.csv")
+PNC_T1_EXCLUDE = os.path.join("PNC", "n1601_t1QaData_v2.csv")
+
+# positions of ICV and the ROIs harmonized among the MUSE volume columns (after ID), as in make_HC.R and make_MS.R
+VOLUME_COLUMNS = [0] + list(range(114, 259))
+MS_SITES = ["CHP", "HSC"]
+
+
+def report_matches(name, res):
+    """Prints the reference IDs left without a match or with several, as inspected after match_obs in make_HC.R."""
+    print(f"{name}: {np.sum(res['row_matches'] >= 0)} matched, {len(res['unmatched'])} unmatched, "
+          f"{len(res['duplicates']['ref_id'])} duplicates")
+    if res['unmatched']:
+        print(f"  unmatched: {res['unmatched']}")
+    for ref_id, dup_targets in zip(res['duplicates']['ref_id'], res['duplicates']['dup_targets']):
+        print(f"  {ref_id} matches {dup_targets}")
+
+def join_volumes(demogr, ref_id, volumes, name, duplicates="drop"):
+    """
+    Binds each row of demogr to the row of volumes whose ID matches ref_id, keeping the selected volume columns.
+    Rows matching several volume IDs are dropped, or bound to their first match with duplicates="first".
+    Rows without a match are dropped, and their number printed.
+    """
+    res = match_obs(list(ref_id), volumes['ID'].tolist())
+    report_matches(name, res)
+    row_matches = res['row_matches'].copy()
+    if duplicates == "first":
+        first = pd.Series(np.arange(len(volumes)), index=volumes['ID']).groupby(level=0).first()
+        dup = np.flatnonzero(np.isin(np.asarray(ref_id), res['duplicates']['ref_id']))
+        row_matches[dup] = first[[targets[0] for targets in res['duplicates']['dup_targets']]].to_numpy()
+    keep = row_matches >= 0
+    if not keep.all():
+        print(f"{name}: dropped {np.sum(~keep)} rows without volumes")
+    rois = volumes.iloc[row_matches[keep], [1 + j for j in VOLUME_COLUMNS]]
+    return pd.concat([demogr[keep].reset_index(drop=True), rois.reset_index(drop=True)], axis=1)
+
+def split_hsc_site(data):
+    """Sets site to HSC-{scanner} for HSC scans, which were acquired on two scanners."""
+    hsc = (data['site'] == "HSC") & data['scanner'].isin(["SIEMENSPRISMAFIT", "SIEMENSTIMTRIO"])
+    data.loc[hsc, 'site'] = "HSC-" + data.loc[hsc, 'scanner']
+    return data
+
+@traced
+def make_deriv(fmt="csv"):
+    """
+    Builds data/deriv/HC_data and MS_data (healthy controls from MSKIDS and PNC; MSKIDS patients from CHP and HSC)
+    from the demographics and MUSE volume exports in data/base, reading each export once.
+    """
+    base = PROJECT_ROOT + BASE_DIR
+
+    # ================================ MSKIDS ================================
+    demogr = pd.read_excel(os.path.join(base, MSK_INVENTORY)).iloc[:-4] # exclude 'legend' rows
+    volumes = pd.read_csv(os.path.join(base, MSK_VOLUMES))
+    demogr = demogr[demogr['MNI QC Result'] == "ACCEPTED"].rename(columns={
+        'Study ID': 'ID', 'Scanner': 'scanner', 'Site of Acquisition': 'site', 'Age at Scan': 'age'})
+    control = demogr['diagnosis_category'] == "HEALTHY CONTROL"
+
+    msk_hc = demogr.loc[control, ['ID', 'scanner', 'site', 'age', 'sex']]
+    msk_hc = join_volumes(msk_hc, msk_hc['ID'], volumes, "MSKIDS controls")
+
+    # scans without a diagnosis are neither: dplyr's filter in make_MS.R drops rows where != gives NA
+    ms = demogr[demogr['diagnosis_category'].notna() & ~control & demogr['site'].isin(MS_SITES)]
+    ms_data = join_volumes(ms[['ID', 'scanner', 'site', 'age', 'sex']], ms['ID'] + "-" + ms['Visit'].str.lower(),
+                           volumes, "MSKIDS patients")
+
+    # ================================ PNC ================================
+    pnc = pd.read_csv(os.path.join(base, PNC_DEMOGRAPHICS))
+    ltn_exclude = pd.read_csv(os.path.join(base, PNC_LTN_EXCLUDE))['ltnExclude'].to_numpy()
+    t1_exclude = pd.read_csv(os.path.join(base, PNC_T1_EXCLUDE))['t1Exclude'].to_numpy()
+    pnc = pnc[(ltn_exclude == 0) & (t1_exclude == 0)]
+
+    # the one duplicate (114738-4738) is the first of its matches. make_HC.R kept unmatched subjects too, but its
+    # fill of the duplicate's row gave them all that row's volumes; they are dropped here instead
+    pnc_data = pd.DataFrame({'ID': "PNC-" + pnc['bblid'].astype(str), 'scanner': "SIEMENSTIMTRIO", 'site': "PNC",
+                             'age': pnc['ageAtGo1Scan'], 'sex': pnc['sex'].map({1: "MALE", 2: "FEMALE"})})
+    pnc_data = join_volumes(pnc_data, pnc['bblid'].astype(str) + "-" + pnc['scanid'].astype(str),
+                            pd.read_csv(os.path.join(base, PNC_VOLUMES)), "PNC", duplicates="first")
+
+    # ================================ harmonization-ready tables ================================
+    hc_data = split_hsc_site(pd.concat([msk_hc, pnc_data], ignore_index=True))
+    ms_data = split_hsc_site(ms_data)
+    print(pd.crosstab(ms_data['scanner'], ms_data['site'])) # consistency between site and scanner
+
+    write_deriv(hc_data, deriv_path(PROJECT_ROOT + DATA_DIR, "HC_data", fmt))
+    write_deriv(ms_data, deriv_path(PROJECT_ROOT + DATA_DIR, "MS_data", fmt))
+
+if __name__ == "__main__":
+    make_deriv()
@@ -0,0 +1,66 @@
+from collections import defaultdict
+import numpy as np
+
+
+class IDIndex:
+    """
+    Inverted index of target IDs by their character q-grams.
+
+    A reference token can only occur in a target ID that contains every q-gram of the token, so intersecting the
+    posting lists of its q-grams narrows the targets to a few candidates, which are then checked for the token itself.
+    Tokens shorter than q do not narrow the candidates and are only checked.
+    """
+
+    def __init__(self, target_id, q=3):
+        self.target_id = [str(x) for x in target_id]
+        self.q = q
+        postings = defaultdict(set)
+        for row, x in enumerate(self.target_id):
+            for j in range(len(x) - q + 1):
+                postings[x[j:j + q]].add(row)
+        self.postings = dict(postings)
+
+    def _candidates(self, token):
+        grams = {token[j:j + self.q] for j in range(len(token) - self.q + 1)}
+        lists = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        return set(lists[0]).intersection(*lists[1:])
+
+    def match(self, tokens):
+        """Rows of the target IDs that contain every token."""
+        indexed = sorted((t for t in tokens if len(t) >= self.q), key=len, reverse=True)
+        if indexed:
+            candidates = self._candidates(indexed[0])
+            for token in indexed[1:]:
+                if not candidates:
+                    break
+                candidates &= self._candidates(token)
+        else:
+            candidates = range(len(self.target_id))
+        return sorted(row for row in candidates if all(token in self.target_id[row] for token in tokens))
+
+
+def match_obs(ref_id, target_id, sep="-", q=3):
+    """
+    Matches two vectors of IDs where vectors may have different formats: a reference ID matches the target IDs
+    containing every one of its sep-separated tokens, e.g. 1234-5678 matches 001234_5678_T1.
+
+    Returns a dict like match_obs.R, with 0-based row_matches into target_id (-1 where there was no single match),
+    the unmatched reference IDs, and the duplicates: reference IDs matching several targets, and those targets.
+    Tokens are matched as plain substrings (grepl in match_obs.R took them as regular expressions).
+    """
+    index = IDIndex(target_id, q)
+
+    row_matches = np.full(len(ref_id), -1)
+    unmatched = []
+    duplicates = {'ref_id': [], 'dup_targets': []}
+    for i, x in enumerate(ref_id):
+        rows = index.match(str(x).split(sep))
+        if len(rows) == 1:
+            row_matches[i] = rows[0]
+        elif len(rows) == 0:
+            unmatched.append(x)
+        else:
+            duplicates['ref_id'].append(x)
+            duplicates['dup_targets'].append([index.target_id[row] for row in rows])
+
+    return {'row_matches': row_matches, 'unmatched': unmatched, 'duplicates': duplicates}
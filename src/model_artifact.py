@@ -0,0 +1,145 @@
+import os
+import json
+import glob
+import pickle
+import numpy as np
+from combat_model import SplineBasis
+
+FORMAT = "ComBat-model"
+FORMAT_VERSION = 1
+
+# arrays kept from a harmonizationLearn model; stand_mean only needs its first column (the grand mean)
+ARRAYS = ['B_hat', 'stand_mean', 'var_pooled', 'gamma_star', 'delta_star', 'gamma_hat', 'delta_hat']
+EB_ARRAYS = ['gamma_bar', 't2', 'a_prior', 'b_prior']
+# per-site sufficient statistics of models from learn_model, which update_model adds new samples to
+STATS_ARRAYS = ['gram', 'cross', 'sq']
+
+
+def artifact_path(pickle_path):
+    """results/models/<name>.pickle -> results/models/<name>.combat"""
+    return os.path.splitext(pickle_path)[0] + ".combat"
+
+def save_artifact(model, path):
+    """
+    Saves a harmonizationLearn model as a directory holding a JSON header and one .npy file per array.
+
+    Only what is needed to apply and update the model is kept; the training design matrix,
+    GAM data frame and per-sample batch info stored in the pickles are dropped.
+    """
+    os.makedirs(path, exist_ok=True)
+    header_path = os.path.join(path, 'header.json')
+    if os.path.exists(header_path): # invalidate the old artifact while arrays are rewritten
+        os.remove(header_path)
+    arrays = {key: np.asarray(model[key], dtype=float) for key in ARRAYS}
+    arrays['stand_mean'] = arrays['stand_mean'][:, [0]]
+    if model['eb']:
+        arrays.update({key: np.asarray(model[key], dtype=float) for key in EB_ARRAYS})
+    stats = model.get('stats')
+    if stats is not None:
+        arrays.update({f'stats_{key}': stats[key] for key in STATS_ARRAYS})
+
+    smooth_model = model['smooth_model']
+    splines = None
+    if smooth_model['perform_smoothing']:
+        bs = smooth_model['bsplines_constructor']
+        if not isinstance(bs, SplineBasis):
+            bs = SplineBasis.from_bsplines(bs)
+        splines = {'degree': [int(d) for d in bs.degree], 'include_intercept': [bool(i) for i in bs.include_intercept]}
+        for i, knots in enumerate(bs.knots):
+            arrays[f'knots_{i}'] = knots
+            if bs.ctransf[i] is not None:
+                arrays[f'ctransf_{i}'] = np.asarray(bs.ctransf[i])
+            if bs.penalty_matrices is not None:
+                arrays[f'penalty_{i}'] = np.asarray(bs.penalty_matrices[i])
+
+    info_dict = model['info_dict']
+    header = {
+        'format': FORMAT,
+        'version': FORMAT_VERSION,
+        'SITE_labels': np.asarray(model['SITE_labels']).tolist(),
+        'Covariates': list(model['Covariates']),
+        'eb': bool(model['eb']),
+        'ref_batch': model.get('ref_batch'),
+        'ref_level': info_dict.get('ref_level'),
+        'n_sample': int(info_dict['n_sample']),
+        'sample_per_batch': [int(n) for n in info_dict['sample_per_batch']],
+        'smooth_terms': list(smooth_model['smooth_terms']),
+        'smooth_cols': [int(c) for c in smooth_model['smooth_cols']],
+        'splines': splines,
+        'age_center': None if model.get('age_center') is None else float(model['age_center']),
+        'eb_method': model.get('eb_method'),
+        'features': None if model.get('features') is None else [str(f) for f in model['features']],
+        'stats_icv_col': None if stats is None or stats['icv_col'] is None else int(stats['icv_col']),
+        'arrays': {key: {'dtype': str(a.dtype), 'shape': list(a.shape)} for key, a in arrays.items()},
+    }
+    # read everything first: a model loaded from this same artifact maps the files about to be rewritten
+    arrays = {key: np.array(a) for key, a in arrays.items()}
+    for key, a in arrays.items():
+        np.save(os.path.join(path, f'{key}.npy'), a)
+    # header last: a directory without one is an incomplete save
+    with open(header_path, 'w') as f:
+        json.dump(header, f, indent=1)
+
+def load_artifact(path, mmap=True):
+    """
+    Loads a model saved by save_artifact as a dict that apply_model accepts.
+
+    With mmap, arrays are memory-mapped read-only, so loading is near instant and worker
+    processes applying the same model share one copy of it in the page cache.
+    """
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('format') != FORMAT or header.get('version', 0) > FORMAT_VERSION:
+        raise ValueError(f"{path} is not a {FORMAT} artifact of version <= {FORMAT_VERSION}")
+
+    arrays = {key: np.load(os.path.join(path, f'{key}.npy'), mmap_mode='r' if mmap else None)
+              for key in header['arrays']}
+
+    bs = None
+    if header['splines'] is not None:
+        n = len(header['splines']['degree'])
+        bs = SplineBasis([arrays[f'knots_{i}'] for i in range(n)],
+                         header['splines']['degree'],
+                         header['splines']['include_intercept'],
+                         [arrays.get(f'ctransf_{i}') for i in range(n)],
+                         [arrays[f'penalty_{i}'] for i in range(n)] if 'penalty_0' in arrays else None)
+
+    model = {key: arrays[key] for key in ARRAYS + EB_ARRAYS if key in arrays}
+    model.update({
+        'SITE_labels': np.array(header['SITE_labels'], dtype=object),
+        'Covariates': header['Covariates'],
+        'eb': header['eb'],
+        'ref_batch': header['ref_batch'],
+        'info_dict': {'n_batch': len(header['SITE_labels']),
+                      'n_sample': header['n_sample'],
+                      'sample_per_batch': np.array(header['sample_per_batch']),
+                      'ref_level': header['ref_level']},
+        'smooth_model': {'perform_smoothing': bs is not None,
+                         'smooth_terms': header['smooth_terms'],
+                         'smooth_cols': header['smooth_cols'],
+                         'bsplines_constructor': bs},
+    })
+    if header['age_center'] is not None:
+        model['age_center'] = header['age_center']
+    if header.get('eb_method') is not None:
+        model['eb_method'] = header['eb_method']
+    if header.get('features') is not None:
+        model['features'] = header['features']
+    if 'stats_sq' in arrays:
+        model['stats'] = {key: arrays[f'stats_{key}'] for key in STATS_ARRAYS}
+        model['stats']['icv_col'] = header['stats_icv_col']
+    return model
+
+def convert_pickles(models_dir):
+    """Writes a .combat artifact next to every model pickle in models_dir that lacks one."""
+    for pickle_path in sorted(glob.glob(os.path.join(models_dir, '*.pickle'))):
+        path = artifact_path(pickle_path)
+        if os.path.exists(os.path.join(path, 'header.json')):
+            continue
+        with open(pickle_path, 'rb') as f:
+            save_artifact(pickle.load(f), path)
+
+if __name__ == "__main__":
+    # python src/model_artifact.py results/models
+    import sys
+    convert_pickles(sys.argv[1])
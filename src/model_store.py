@@ -0,0 +1,107 @@
+import os
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+STORE_VERSION = 3
+# modules whose code computes the fits; a change to any of them misses every entry stored before it
+ENGINE_SOURCES = ["combat_model.py", "stratified_ComBat.py"]
+
+
+def _engine_hash():
+    h = hashlib.sha256()
+    for name in ENGINE_SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+ENGINE_HASH = _engine_hash()
+
+
+def input_key(*parts):
+    """
+    Content hash of the inputs to a fit and of the code fitting them (ENGINE_SOURCES).
+
+    parts can be numpy arrays, DataFrames (values and column names are hashed) or anything
+    with a stable repr (strings, bools, lists of smooth terms, stratum keys).
+    """
+    h = hashlib.sha256(f"v{STORE_VERSION}-{ENGINE_HASH}".encode())
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            h.update(repr(list(part.columns)).encode())
+            h.update(pd.util.hash_pandas_object(part, index=False).values.tobytes())
+        elif isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(f"{part.dtype}{part.shape}".encode())
+            h.update(part.tobytes())
+        else:
+            h.update(repr(part).encode())
+        h.update(b"|")
+    return h.hexdigest()
+
+
+class ModelStore:
+    """
+    Content-addressed cache of fitted models and their adjusted data, one pickle per key.
+
+    Entries are evicted least-recently-used first (by file mtime, refreshed on every hit)
+    once the store grows beyond max_bytes. Writes are atomic, so worker processes can share a store.
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.pickle")
+
+    def get(self, key):
+        """Returns the cached value for key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path) # mark as recently used
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def put(self, key, value):
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries until the store fits in max_bytes."""
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".pickle"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except FileNotFoundError: # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def cached(self, key, fit):
+        """Returns the value stored under key, computing it with fit() and storing it on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = fit()
+            self.put(key, value)
+        return value
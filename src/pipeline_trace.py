@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+import pandas as pd
+
+# Tracing is opt-in: set COMBAT_TRACE to a file (or call enable_trace) and every stage appends one JSON line to it,
+# from worker processes too, which inherit the environment. Set COMBAT_TRACE_SUMMARY=1 to also print a summary
+# table when each outermost traced call returns.
+TRACE_ENV = "COMBAT_TRACE"
+SUMMARY_ENV = "COMBAT_TRACE_SUMMARY"
+
+_local = threading.local()
+
+
+def enable_trace(path, summary=False):
+    os.environ[TRACE_ENV] = os.path.abspath(path)
+    if summary:
+        os.environ[SUMMARY_ENV] = "1"
+
+def disable_trace():
+    os.environ.pop(TRACE_ENV, None)
+    os.environ.pop(SUMMARY_ENV, None)
+
+def _peak_rss_mb():
+    """High-water resident set size of this process; ru_maxrss is in kilobytes on Linux, bytes on macOS."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+@contextmanager
+def _span(trace_file, name, tags):
+    stack = _local.__dict__.setdefault('stack', [])
+    parent = "/".join(stack)
+    stack.append(name)
+    record = {'stage': name, 'parent': parent, **tags, 'pid': os.getpid(), 'start': time.time()}
+    peak, wall, cpu = _peak_rss_mb(), time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = type(error).__name__
+        raise
+    finally:
+        stack.pop()
+        # peak RSS cannot be reset per stage: report the process high-water mark and how much the stage raised it
+        record.update({'wall_s': time.perf_counter() - wall, 'cpu_s': time.process_time() - cpu,
+                       'peak_rss_mb': _peak_rss_mb()})
+        record['peak_rss_increase_mb'] = record['peak_rss_mb'] - peak
+        with open(trace_file, 'a') as f:
+            f.write(json.dumps(record, default=str) + "\n")
+        if not stack and os.environ.get(SUMMARY_ENV):
+            print(summarize_trace(trace_file, since=record['start']).to_string(), file=sys.stderr)
+
+def stage(name, **tags):
+    """
+    Context manager recording the wall time, CPU time and peak RSS of a pipeline stage, with its tags
+    (e.g. stratum="MALE") and the stages it runs within, when tracing is on; otherwise it does nothing.
+    """
+    trace_file = os.environ.get(TRACE_ENV)
+    if not trace_file:
+        return nullcontext()
+    return _span(trace_file, name, tags)
+
+def traced(fn):
+    """Decorator tracing each call of fn as a stage named after it."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with stage(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def current_stage():
+    """Path of the stages the caller runs within, for run_within in a worker process."""
+    return "/".join(getattr(_local, 'stack', []))
+
+def run_within(path, fn, *args):
+    """Calls fn(*args) as if within the stages of path, e.g. the current_stage() of the process that submitted it."""
+    stack = _local.__dict__.setdefault('stack', [])
+    saved = stack[:]
+    stack[:] = path.split("/") if path else []
+    try:
+        return fn(*args)
+    finally:
+        stack[:] = saved
+
+def read_trace(trace_file):
+    """The trace as a DataFrame, one row per stage run."""
+    with open(trace_file) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+def summarize_trace(trace_file, by=("parent", "stage"), since=None):
+    """
+    Totals per stage of a trace: number of runs, wall and CPU time, highest peak RSS and largest increase of it.
+    by may add tags such as "stratum"; since (a time.time() value) keeps only the stages started from then on.
+    """
+    trace = read_trace(trace_file)
+    if since is not None:
+        trace = trace[trace.start >= since]
+    by = [col for col in by if col in trace.columns]
+    return (trace.groupby(by, sort=False, dropna=False)
+            .agg(runs=('stage', 'size'), wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'),
+                 peak_rss_mb=('peak_rss_mb', 'max'), peak_rss_increase_mb=('peak_rss_increase_mb', 'max'))
+            .round(3))
+
+if __name__ == "__main__":
+    # python pipeline_trace.py trace.jsonl [column ...]
+    print(summarize_trace(sys.argv[1], by=sys.argv[2:] or ("parent", "stage")).to_string())
@@ -0,0 +1,228 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import stats
+from deriv_store import read_deriv
+from stratified_ComBat import feature_columns
+from pipeline_trace import traced
+
+PROJECT_ROOT = "/Users/vgonzenb/PennSIVE/MSKIDS/"
+DATA_DIR = os.path.join("data", "deriv")
+
+PERM_BLOCK = 100 # permutations per block; blocks get their own seeds, so p-values do not depend on n_jobs
+
+
+## Designs
+
+def covariate_design(data, icv_col=None, interaction=True):
+    """
+    Covariates of the site-effect models of eval_adj_data.Rmd, one column per term: intercept, age and centered
+    age squared, sex (if data holds both), MS (for HC+MS tables), with interaction their products with both age
+    terms (check_roi_site_fx's mod_interaction), and with icv_col, ICV. Age terms come second and third.
+    """
+    age = data.age.to_numpy(dtype=float) - data.age.mean()
+    columns = [np.ones(len(data)), age, age ** 2]
+    groups = []
+    if data.sex.nunique() > 1:
+        groups.append((data.sex == "MALE").to_numpy(dtype=float))
+    if 'MS' in data and data.MS.nunique() > 1:
+        groups.append(data.MS.to_numpy(dtype=float))
+    for group in groups:
+        columns += [group, group * age, group * age ** 2] if interaction else [group]
+    if icv_col is not None:
+        icv = data[icv_col].to_numpy(dtype=float)
+        columns.append((icv - icv.mean()) / icv.std())
+    return np.column_stack(columns)
+
+def _orth(X):
+    """Orthonormal basis of the column space of X, dropping directions it does not span (collinear columns)."""
+    U, s, _ = np.linalg.svd(X, full_matrices=False)
+    return U[:, s > s.max() * max(X.shape) * np.finfo(float).eps]
+
+def _residuals(Q, Y):
+    return Y - Q @ (Q.T @ Y)
+
+def _site_dummies(codes, n_sites):
+    return (codes[:, None] == np.arange(1, n_sites)).astype(float) # first site as reference
+
+
+## Statistics for all features at once
+
+def _mean_F(R0, Qs, df1, df2):
+    """Nested-model F of site given the covariates, from the covariate model's residuals R0 and the site basis Qs."""
+    rss0 = np.einsum('ij,ij->j', R0, R0)
+    ss_site = np.sum((Qs.T @ R0) ** 2, axis=0)
+    return (ss_site / df1) / ((rss0 - ss_site) / df2), ss_site, rss0
+
+def _levene_F(R, codes, n_sites):
+    """Brown-Forsythe test of equal variances across sites: one-way ANOVA F of absolute deviations from site medians."""
+    counts = np.bincount(codes, minlength=n_sites)
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    R = R[np.argsort(codes, kind='stable')] # each site's rows as one contiguous block
+    Z = np.empty_like(R)
+    for g in range(n_sites):
+        block = R[bounds[g]:bounds[g + 1]]
+        Z[bounds[g]:bounds[g + 1]] = np.abs(block - np.median(block, axis=0))
+    means = np.add.reduceat(Z, bounds[:-1], axis=0) / counts[:, None]
+    between = counts @ (means - Z.mean(axis=0)) ** 2
+    D = Z - np.repeat(means, counts, axis=0)
+    within = np.einsum('ij,ij->j', D, D)
+    return (between / (n_sites - 1)) / (within / (len(R) - n_sites))
+
+def _perm_block(R0, Q0, Qs, R1, codes, n_sites, df1, df2, F_mean, F_var, n_perm, seed):
+    """
+    Counts the permutations at least as extreme as the observed statistics: Freedman-Lane (permuted residuals of
+    the covariate model) for the mean test, permuted site labels of the full model's residuals for the variance test.
+    """
+    rng = np.random.default_rng(seed)
+    exceed_mean = np.zeros(R0.shape[1], dtype=int)
+    exceed_var = np.zeros(R0.shape[1], dtype=int)
+    for _ in range(n_perm):
+        perm = rng.permutation(len(R0))
+        exceed_mean += _mean_F(_residuals(Q0, R0[perm]), Qs, df1, df2)[0] >= F_mean
+        exceed_var += _levene_F(R1, codes[perm], n_sites) >= F_var
+    return exceed_mean, exceed_var
+
+def _permutations(args, n_perm, seed, n_jobs):
+    blocks = [min(PERM_BLOCK, n_perm - start) for start in range(0, n_perm, PERM_BLOCK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+    if n_jobs is None:
+        n_jobs = min(len(blocks), os.cpu_count() or 1)
+    if n_jobs <= 1 or len(blocks) <= 1:
+        counts = [_perm_block(*args, n, s) for n, s in zip(blocks, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            counts = list(pool.map(_perm_block, *zip(*[args + (n, s) for n, s in zip(blocks, seeds)])))
+    return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+def _site_tests(Y, X0, sites, n_perm, seed, n_jobs):
+    labels, codes = np.unique(sites, return_inverse=True)
+    n_sites = len(labels)
+    Q0 = _orth(X0)
+    Qs = _orth(_residuals(Q0, _site_dummies(codes, n_sites)))
+    df1, df2 = Qs.shape[1], len(Y) - Q0.shape[1] - Qs.shape[1]
+
+    R0 = _residuals(Q0, Y)
+    F_mean, ss_site, rss0 = _mean_F(R0, Qs, df1, df2)
+    R1 = R0 - Qs @ (Qs.T @ R0)
+    F_var = _levene_F(R1, codes, n_sites)
+
+    result = {'mean_F': F_mean, 'mean_p': stats.f.sf(F_mean, df1, df2),
+              'var_F': F_var, 'var_p': stats.f.sf(F_var, n_sites - 1, len(Y) - n_sites),
+              'site_r2': ss_site / rss0} # partial R^2: share of the variance left by the covariates explained by site
+    if n_perm:
+        exceed_mean, exceed_var = _permutations((R0, Q0, Qs, R1, codes, n_sites, df1, df2, F_mean, F_var),
+                                                n_perm, seed, n_jobs)
+        result.update({'mean_p_perm': (1 + exceed_mean) / (1 + n_perm), 'var_p_perm': (1 + exceed_var) / (1 + n_perm)})
+    return result
+
+
+## Diagnostics
+
+def _features(data):
+    """ICV and the ROIs with the rows where all are present (apply scripts leave rows from unseen sites as NaN)."""
+    icv_col, roi_cols = feature_columns(data)
+    return data[data[[icv_col] + roi_cols].notna().all(axis=1)].reset_index(drop=True), icv_col, roi_cols
+
+@traced
+def site_diagnostics(data, n_perm=1000, seed=0, n_jobs=None, interaction=True):
+    """
+    Tests every feature of a data/deriv table (raw, or adjusted by any learn/apply script) for site effects
+    left after the covariates of covariate_design (ROIs also given ICV; group-by-age interactions unless
+    interaction is False), all features at once:
+
+    mean_F, mean_p      F test of site added to the covariate model (as in eval_adj_data.Rmd)
+    var_F, var_p        Brown-Forsythe test of equal residual variance across sites
+    site_r2             share of the variance left by the covariates that site explains
+    *_p_perm            permutation p-values from n_perm permutations (0 to skip), run in blocks in
+                        n_jobs processes; the result depends on seed only
+
+    Returns a DataFrame with one row per feature.
+    """
+    data, icv_col, roi_cols = _features(data)
+    tests = []
+    designs = covariate_design(data, interaction=interaction), covariate_design(data, icv_col, interaction)
+    for cols, design in zip(([icv_col], roi_cols), designs):
+        Y = data[cols].to_numpy(dtype=float)
+        tests.append(pd.DataFrame(_site_tests(Y, design, data.site.to_numpy(), n_perm, seed, n_jobs), index=cols))
+    return pd.concat(tests)
+
+@traced
+def trajectory_preservation(raw, adjusted, n_grid=50):
+    """
+    Compares the age trajectory of each feature before and after harmonization: the age + age squared curve of
+    a model with the covariates (without interactions) and site, evaluated over the observed ages, for raw and
+    adjusted values of the same scans in the same order (as the learn/apply scripts write them).
+
+    age_corr    correlation of the raw and adjusted curves (shape)
+    age_ratio   sd of the adjusted curve over sd of the raw one (amplitude)
+    age_p_raw, age_p_adj    F test of the age terms in each
+
+    Returns a DataFrame with one row per feature.
+    """
+    if len(raw) != len(adjusted):
+        raise ValueError(f"raw and adjusted must hold the same scans in the same order, got {len(raw)} and {len(adjusted)} rows")
+    icv_col, roi_cols = feature_columns(raw)
+    keep = (raw[[icv_col] + roi_cols].notna().all(axis=1) & adjusted[[icv_col] + roi_cols].notna().all(axis=1)).to_numpy()
+    raw, adjusted = raw[keep].reset_index(drop=True), adjusted[keep].reset_index(drop=True)
+
+    _, codes = np.unique(raw.site, return_inverse=True)
+    sites = _site_dummies(codes, codes.max() + 1)
+    grid = np.linspace(raw.age.min(), raw.age.max(), n_grid) - raw.age.mean()
+    curves = np.column_stack([grid, grid ** 2])
+
+    result = []
+    for cols, icv in (([icv_col], None), (roi_cols, icv_col)):
+        curve, age_p = {}, {}
+        for name, data in (('raw', raw), ('adj', adjusted)):
+            X = np.column_stack([covariate_design(data, icv, interaction=False), sites])
+            Y = data[cols].to_numpy(dtype=float)
+            B = np.linalg.lstsq(X, Y, rcond=None)[0]
+            curve[name] = curves @ B[1:3]
+            # F test of the age terms
+            Q1, Q0 = _orth(X), _orth(np.delete(X, [1, 2], axis=1))
+            rss1 = np.sum(_residuals(Q1, Y) ** 2, axis=0)
+            rss0 = np.sum(_residuals(Q0, Y) ** 2, axis=0)
+            df1, df2 = Q1.shape[1] - Q0.shape[1], len(Y) - Q1.shape[1]
+            age_p[name] = stats.f.sf(((rss0 - rss1) / df1) / (rss1 / df2), df1, df2)
+        c_raw, c_adj = curve['raw'] - curve['raw'].mean(axis=0), curve['adj'] - curve['adj'].mean(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = np.sum(c_raw * c_adj, axis=0) / np.sqrt(np.sum(c_raw ** 2, axis=0) * np.sum(c_adj ** 2, axis=0))
+            ratio = c_adj.std(axis=0) / c_raw.std(axis=0)
+        result.append(pd.DataFrame({'age_corr': corr, 'age_ratio': ratio,
+                                    'age_p_raw': age_p['raw'], 'age_p_adj': age_p['adj']}, index=cols))
+    return pd.concat(result)
+
+def count_significant(p, alpha=0.05):
+    """Number of features significant after FDR (Benjamini-Hochberg) and Bonferroni correction, and uncorrected."""
+    p = np.asarray(p, dtype=float)
+    order = np.sort(p)
+    below = np.flatnonzero(order <= alpha * np.arange(1, len(p) + 1) / len(p))
+    return pd.Series({'FDR': int(below[-1] + 1) if len(below) else 0, 'Bonferroni': int(np.sum(p < alpha / len(p))),
+                      'Uncorrected P': int(np.sum(p < alpha))})
+
+@traced
+def evaluate_harmonization(raw, adjusted, n_perm=1000, seed=0, n_jobs=None):
+    """
+    Before/after diagnostics of one configuration: site_diagnostics of the raw and the adjusted table (prefixed
+    raw_ and adj_) and trajectory_preservation, one row per feature, plus the number of features with site effects
+    in each (counts of the mean and variance tests' p-values, permutation ones if computed).
+    raw and adjusted are DataFrames or paths under data/deriv.
+    """
+    if isinstance(raw, str):
+        raw = read_deriv(os.path.join(PROJECT_ROOT + DATA_DIR, raw))
+    if isinstance(adjusted, str):
+        adjusted = read_deriv(os.path.join(PROJECT_ROOT + DATA_DIR, adjusted))
+    before = site_diagnostics(raw, n_perm, seed, n_jobs)
+    after = site_diagnostics(adjusted, n_perm, seed, n_jobs)
+    table = pd.concat([before.add_prefix('raw_'), after.add_prefix('adj_'), trajectory_preservation(raw, adjusted)], axis=1)
+
+    suffix = "_p_perm" if n_perm else "_p"
+    counts = pd.DataFrame({f"{when}_{test}": count_significant(table[f"{when}_{test}{suffix}"])
+                           for when in ('raw', 'adj') for test in ('mean', 'var')})
+    return table, counts
+
+if __name__ == "__main__":
+    table, counts = evaluate_harmonization("HC_data.csv", "HC_data_adj_ComBat-GAM_split-MF_eb-True.csv")
+    print(counts)
@@ -0,0 +1,430 @@
+import os
+import json
+import time
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from combat_model import apply_model, learn_model, learn_model_chunked, model_features, update_model, learn_roi_step, apply_two_step
+from model_store import input_key
+from model_artifact import save_artifact, load_artifact, artifact_path
+from deriv_store import deriv_columns, read_deriv, iter_deriv, write_deriv_chunks
+from pipeline_trace import stage, traced, current_stage, run_within
+
+MODS = ("GAM", "Linear")
+
+# non-feature columns of the tables in data/deriv; the first other column is ICV, the rest are ROIs
+DEMOGRAPHICS = ['ID', 'scanner', 'site', 'age', 'sex', 'MS', 'cohort']
+
+
+## Covariates used by each script. Defined at module level so they can be shipped to worker processes.
+
+def covars_with_sex(data, mod, age_center=None):
+    """SITE, AGE and sex dummies (unsplit ComBat-GAM models)."""
+    covars = pd.DataFrame({'SITE': data.site, 'AGE': data.age})
+    # sex dummies, spelled out so that both columns exist even if data holds one sex
+    covars['FEMALE'] = data.sex == "FEMALE"
+    covars['MALE'] = data.sex == "MALE"
+    return covars
+
+def covars_by_sex(data, mod, age_center=None):
+    """
+    SITE and AGE, plus centered AGE_SQUARED for Linear models (models split by sex).
+    AGE is centered on age_center if given, else on the mean age of data.
+    """
+    covars = pd.DataFrame({'SITE': data.site, 'AGE': data.age})
+    if mod == "Linear":
+        if age_center is None:
+            age_center = covars.AGE.mean()
+        covars["AGE_SQUARED"] = (covars.AGE - age_center) ** 2 # center before squaring (second moment)
+    return covars
+
+def covars_with_MS(data, mod, age_center=None):
+    """SITE, AGE, MS status and their interactions (models learned from HC+MS)."""
+    covars = pd.DataFrame({'SITE': data.site, 'AGE': data.age, 'MS': data.MS})
+    covars["AGE_BY_MS"] = covars['AGE'] * covars['MS']
+    if mod == "Linear":
+        if age_center is None:
+            age_center = covars.AGE.mean()
+        covars["AGE_SQUARED"] = (covars.AGE - age_center) ** 2 # center before squaring (second moment)
+        covars["AGE_SQ_BY_MS"] = covars["AGE_SQUARED"] * covars["MS"]
+    return covars
+
+
+## Per-stratum workers
+
+def _smooth_terms(mod):
+    return ['AGE'] if mod == "GAM" else []
+
+def _learn_stratum(icv, rois, covars, mod, eb, store=None, key=None, eb_method="parametric", gam="batched", penweight="feature"):
+    """
+    Fits the two-step ICV->ROI model for a single stratum with learn_model: GAMs are fit with the
+    gam backend, and the ROI step's empirical Bayes estimates are computed for all ROIs at once.
+
+    With a ModelStore, each step is looked up by a hash of its inputs first. The ROI step is keyed
+    on the ICV step's key, so changing only eb refits the ROI step and reuses the ICV fit.
+
+    With the batched backend, the steps are fused as in learn_two_step: ICV is fit as a single feature and the
+    ROI step reuses its design. Adjusted ICV and ROIs are written into one array, ICV first.
+    """
+    smooth_terms = _smooth_terms(mod)
+    out = np.empty((len(icv), 1 + rois.shape[1]))
+
+    # Step 1; harmonizationLearn's own fit keeps the stacked ICV (two identical features) it was run on
+    def fit_icv():
+        if gam == "batched":
+            return learn_model(icv[:, None], covars, smooth_terms=smooth_terms, eb=False, penweight=penweight, out=out[:, :1])
+        return learn_model(np.stack((icv, icv)).T, covars, smooth_terms=smooth_terms, eb=False, gam=gam, penweight=penweight)
+
+    icv_key = input_key("ICV", icv, covars, mod, smooth_terms, gam, penweight, key)
+    with stage("fit_ICV", stratum=stratum_name(key), samples=len(icv)):
+        mod_icv, icv_adj = fit_icv() if store is None else store.cached(icv_key, fit_icv)
+    if not np.shares_memory(icv_adj, out):
+        out[:, 0] = icv_adj[:, 0]
+
+    # Step 2
+    def fit_rois():
+        if gam == "batched":
+            return learn_roi_step(mod_icv, icv, out[:, 0], rois, eb, eb_method, penweight, out=out[:, 1:])
+        return learn_model(rois, covars.assign(ICV_adj=out[:, 0]), smooth_terms=smooth_terms, eb=eb, eb_method=eb_method,
+                           gam=gam, penweight=penweight, icv=icv)
+
+    rois_key = input_key("ROIs", icv_key, rois, mod, eb, eb_method, smooth_terms, gam, penweight, key)
+    with stage("fit_ROIs", stratum=stratum_name(key), samples=len(rois)):
+        mod_rois, rois_adj = fit_rois() if store is None else store.cached(rois_key, fit_rois)
+    if not np.shares_memory(rois_adj, out):
+        out[:, 1:] = rois_adj
+
+    # keep the training age that AGE_SQUARED is centered on, so new data is centered the same way
+    mod_icv['age_center'] = mod_rois['age_center'] = covars.AGE.mean()
+
+    return (mod_icv, mod_rois), out
+
+def _update_stratum(icv, rois, covars, models, penweight="feature", key=None):
+    """Adds a stratum's new samples to its (ICV model, ROI model) pair; returns them harmonized by the updated pair."""
+    model_icv, model_rois = models
+    out = np.empty((len(icv), 1 + rois.shape[1]))
+    with stage("update_ICV", stratum=stratum_name(key), samples=len(icv)):
+        model_icv, icv_adj = update_model(model_icv, icv[:, None], covars, penweight)
+    out[:, 0] = covars['ICV_adj'] = icv_adj[:, 0]
+    with stage("update_ROIs", stratum=stratum_name(key), samples=len(rois)):
+        model_rois, out[:, 1:] = update_model(model_rois, rois, covars, penweight, icv=icv, icv_model=model_icv)
+
+    return (model_icv, model_rois), out
+
+def _apply_stratum(icv, rois, covars, models, key=None):
+    """Applies a stratum's (ICV model, ROI model) pair with apply_two_step."""
+    with stage("apply_stratum", stratum=stratum_name(key), samples=len(icv)):
+        return apply_two_step(icv, rois, covars, models)
+
+
+## Engine
+
+def feature_columns(data):
+    """Names of the ICV column and of the ROI columns of a data/deriv table (or a list of its column names)."""
+    columns = data.columns if isinstance(data, pd.DataFrame) else data
+    features = [c for c in columns if c not in DEMOGRAPHICS]
+    return features[0], features[1:]
+
+def strata_indices(data, strata=None):
+    """
+    Maps each stratum key to the row positions it covers in data.
+
+    strata can be None (a single stratum), a column name, a list of column names
+    or an array-like of labels aligned with data (e.g. pd.cut(data.age, bins) for age bands).
+    Rows with a missing stratum label are not assigned to any stratum.
+    """
+    if strata is None:
+        return {None: np.arange(len(data))}
+    return data.groupby(strata, sort=False).indices
+
+def stratum_name(key):
+    """Label used for a stratum in file names: None -> '', 'MALE' -> 'MALE', ('MALE', 'RRMS') -> 'MALE_RRMS'."""
+    if key is None:
+        return ""
+    if isinstance(key, tuple):
+        return "_".join(str(k) for k in key)
+    return str(key)
+
+def _run(fn, jobs, n_jobs):
+    """Runs fn over a dict of argument tuples, in a process pool when there is more than one job."""
+    if n_jobs is None:
+        n_jobs = min(len(jobs), os.cpu_count() or 1)
+    if n_jobs <= 1 or len(jobs) <= 1:
+        return {key: fn(*args) for key, args in jobs.items()}
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {key: pool.submit(run_within, current_stage(), fn, *args) for key, args in jobs.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+def _jobs(data, strata, covars_fn, mod, icv_col, roi_cols, age_centers=None):
+    indices = strata_indices(data, strata)
+    icv = data[icv_col].to_numpy(dtype=float)
+    rois = data[roi_cols].to_numpy(dtype=float) # the whole ROI block as one float array
+    jobs = {}
+    for key, idx in indices.items():
+        age_center = None if age_centers is None else age_centers.get(key)
+        if len(idx) == len(data): # a single stratum: no need to copy rows out
+            jobs[key] = (icv, rois, covars_fn(data, mod, age_center))
+        else:
+            jobs[key] = (icv[idx], rois[idx], covars_fn(data.iloc[idx], mod, age_center))
+    return indices, jobs
+
+def harmonized_frame(data, indices, results, icv_col, roi_cols):
+    """
+    Writes each stratum's adjusted [ICV, ROIs] block into one array in the original row order,
+    and returns data with its feature columns taken from it.
+    """
+    out = np.full((len(data), 1 + len(roi_cols)), np.nan)
+    for key, idx in indices.items():
+        out[idx] = results[key]
+
+    # the array becomes the frame's float block as is; only the demographic columns are copied
+    features = pd.DataFrame(out, index=data.index, columns=[icv_col] + list(roi_cols), copy=False)
+    data_adj = pd.concat([data.drop(columns=features.columns), features], axis=1, copy=False)
+    return data_adj if data_adj.columns.equals(data.columns) else data_adj[data.columns]
+
+@traced
+def learn_strata(data, covars_fn, strata=None, mod="GAM", eb=True, icv_col=None, roi_cols=None, n_jobs=None, store=None,
+                 eb_method="parametric", gam="batched", penweight="feature"):
+    """
+    Learns the two-step ICV->ROI ComBat model separately within each stratum, fitting strata concurrently.
+    If a ModelStore is given, fits whose inputs are unchanged are read from it instead of refit.
+    icv_col and roi_cols name the feature columns; by default they are taken from feature_columns(data).
+    eb_method selects the parametric or nonparametric empirical Bayes estimates when eb is True, and gam
+    the GAM backend: "batched" (one penalized least-squares solve for all ROIs) or "statsmodels" (one GLMGam per ROI);
+    penweight whether the batched backend picks the smoothing penalty per ROI ("feature") or once for all ROIs ("shared").
+
+    Returns a dict of {stratum: (ICV model, ROI model)}, each model with the names of its feature columns as
+    features, and the adjusted DataFrame in the original row order.
+    """
+    if mod not in MODS:
+        raise ValueError(f"mod must be one of {MODS}, got {mod!r}")
+
+    if icv_col is None:
+        icv_col, roi_cols = feature_columns(data)
+    with stage("covariates"):
+        indices, jobs = _jobs(data, strata, covars_fn, mod, icv_col, roi_cols)
+    with stage("run_strata", strata=len(jobs), n_jobs=n_jobs):
+        fits = _run(_learn_stratum, {key: args + (mod, eb, store, key, eb_method, gam, penweight) for key, args in jobs.items()}, n_jobs)
+
+    models = {key: fit[0] for key, fit in fits.items()}
+    for model_icv, model_rois in models.values(): # so new tables can be matched to the models by column name
+        model_icv['features'], model_rois['features'] = [icv_col], list(roi_cols)
+    results = {key: fit[1] for key, fit in fits.items()}
+    with stage("reassemble"):
+        return models, harmonized_frame(data, indices, results, icv_col, roi_cols)
+
+@traced
+def apply_strata(data, models, covars_fn, strata=None, mod="GAM", icv_col=None, roi_cols=None, n_jobs=None, age_centers=None):
+    """
+    Applies per-stratum models from learn_strata/load_models to new data; returns the adjusted DataFrame.
+    Each stratum may contain any subset of its model's training sites; rows from unseen sites come back as NaN.
+    AGE is centered on the training age stored with each model; for older models without one,
+    age_centers optionally fixes the {stratum: age} to use instead of each stratum's mean age.
+    """
+    if age_centers is None:
+        age_centers = {key: model_icv.get('age_center') for key, (model_icv, _) in models.items()}
+    if icv_col is None:
+        icv_col, roi_cols = feature_columns(data)
+    with stage("covariates"):
+        indices, jobs = _jobs(data, strata, covars_fn, mod, icv_col, roi_cols, age_centers)
+    missing = set(jobs) - set(models)
+    if missing:
+        raise ValueError(f"No models for strata: {sorted(map(stratum_name, missing))}")
+
+    with stage("run_strata", strata=len(jobs), n_jobs=n_jobs):
+        results = _run(_apply_stratum, {key: args + (models[key], key) for key, args in jobs.items()}, n_jobs)
+    with stage("reassemble"):
+        return harmonized_frame(data, indices, results, icv_col, roi_cols)
+
+@traced
+def update_strata(models, data, covars_fn, strata=None, mod="GAM", icv_col=None, roi_cols=None, n_jobs=None, penweight="feature"):
+    """
+    Adds new samples (e.g. healthy controls scanned since the models were learned) to per-stratum models from
+    learn_strata/load_models with update_model, without the training data. Samples may come from new sites.
+    AGE is centered on the training age stored with each model. Strata without new samples keep their models.
+
+    Returns the updated models and the new samples harmonized by them, in the original row order.
+    """
+    age_centers = {key: model_icv.get('age_center') for key, (model_icv, _) in models.items()}
+    if icv_col is None:
+        icv_col, roi_cols = feature_columns(data)
+    with stage("covariates"):
+        indices, jobs = _jobs(data, strata, covars_fn, mod, icv_col, roi_cols, age_centers)
+    missing = set(jobs) - set(models)
+    if missing:
+        raise ValueError(f"No models for strata: {sorted(map(stratum_name, missing))}")
+
+    with stage("run_strata", strata=len(jobs), n_jobs=n_jobs):
+        fits = _run(_update_stratum, {key: args + (models[key], penweight, key) for key, args in jobs.items()}, n_jobs)
+
+    updated = dict(models)
+    updated.update({key: fit[0] for key, fit in fits.items()})
+    results = {key: fit[1] for key, fit in fits.items()}
+    with stage("reassemble"):
+        return updated, harmonized_frame(data, indices, results, icv_col, roi_cols)
+
+@traced
+def apply_strata_chunked(data_file, out_file, models, covars_fn, strata=None, mod="GAM", chunksize=5000):
+    """
+    Streaming version of apply_strata: reads data_file (CSV or Parquet) chunksize rows at a time, adjusts
+    each chunk and appends it to out_file, so memory is bounded by the chunk size rather than the table size.
+
+    strata must be None or column name(s). ComBat apply is row-independent once the model is fixed.
+    Models saved without their training age center are centered on each stratum's mean age in the
+    whole table, computed in a first pass over the demographic columns, as apply_strata would.
+    """
+    columns = deriv_columns(data_file)
+    icv_col, roi_cols = feature_columns(columns)
+
+    age_centers = None
+    if any('age_center' not in model_icv for model_icv, _ in models.values()):
+        demogr = read_deriv(data_file, columns=[c for c in columns if c in DEMOGRAPHICS])
+        age_centers = {key: covars_fn(demogr.iloc[idx], mod).AGE.mean()
+                       for key, idx in strata_indices(demogr, strata).items()}
+        del demogr
+
+    write_deriv_chunks((apply_strata(chunk, models, covars_fn, strata, mod, icv_col, roi_cols, n_jobs=1, age_centers=age_centers)
+                        for chunk in iter_deriv(data_file, chunksize)), out_file)
+
+## Memory-mapped feature matrices (voxel- or vertex-wise maps)
+
+def _open_features(data, features_file, out_file, dtype):
+    features = np.load(features_file, mmap_mode='r')
+    if features.ndim != 2 or len(features) != len(data):
+        raise ValueError(f"{features_file} must hold one row of features per row of data ({len(data)}), got shape {features.shape}")
+    return features, np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=features.shape)
+
+def _fill_unassigned(out, indices):
+    """Rows outside every stratum are NaN in the output, as in harmonized_frame."""
+    assigned = np.zeros(len(out), dtype=bool)
+    for idx in indices.values():
+        assigned[idx] = True
+    out[~assigned] = np.nan
+    out.flush()
+
+@traced
+def learn_strata_memmap(data, features_file, out_file, covars_fn, strata=None, mod="GAM", eb=True, icv_col=None,
+                        chunksize=10000, dtype=np.float64):
+    """
+    Out-of-core learn_strata for feature matrices too large for memory. ICV is data[icv_col] (by default the
+    first feature column of data), and the features harmonized in the second step are a .npy file
+    (N_samples x N_features, rows aligned with data) that is memory-mapped and fit chunksize features at a time
+    by learn_model_chunked. Harmonized features are written to the .npy out_file with the given dtype
+    (np.float32 halves its size). Strata are fit one after the other.
+
+    Returns a dict of {stratum: (ICV model, ROI model)} and data with ICV adjusted; the "ROI" model covers the features.
+    """
+    if mod not in MODS:
+        raise ValueError(f"mod must be one of {MODS}, got {mod!r}")
+    if icv_col is None:
+        icv_col = feature_columns(data)[0]
+    features, out = _open_features(data, features_file, out_file, dtype)
+
+    smooth_terms = _smooth_terms(mod)
+    icv = data[icv_col].to_numpy(dtype=float)
+    icv_adj = np.full(len(data), np.nan)
+    indices = strata_indices(data, strata)
+    models = {}
+    for key, idx in indices.items():
+        covars = covars_fn(data.iloc[idx], mod)
+        with stage("fit_ICV", stratum=stratum_name(key), samples=len(idx)):
+            mod_icv, adj = learn_model(icv[idx][:, None], covars, smooth_terms=smooth_terms, eb=False)
+        icv_adj[idx] = covars['ICV_adj'] = adj[:, 0]
+        with stage("fit_features", stratum=stratum_name(key), samples=len(idx), features=features.shape[1]):
+            mod_rois = learn_model_chunked(features, covars, out, smooth_terms, eb, rows=idx, chunksize=chunksize)
+        mod_icv['age_center'] = mod_rois['age_center'] = covars.AGE.mean()
+        models[key] = (mod_icv, mod_rois)
+    _fill_unassigned(out, indices)
+
+    data_adj = data.copy()
+    data_adj[icv_col] = icv_adj
+    return models, data_adj
+
+@traced
+def apply_strata_memmap(data, features_file, out_file, models, covars_fn, strata=None, mod="GAM", icv_col=None,
+                        chunksize=10000, dtype=np.float64):
+    """
+    Out-of-core apply_strata: applies models from learn_strata_memmap/load_models to a memory-mapped .npy feature
+    matrix chunksize features at a time, writing the harmonized features to out_file. Returns data with ICV adjusted.
+    """
+    if icv_col is None:
+        icv_col = feature_columns(data)[0]
+    features, out = _open_features(data, features_file, out_file, dtype)
+
+    icv = data[icv_col].to_numpy(dtype=float)
+    icv_adj = np.full(len(data), np.nan)
+    indices = strata_indices(data, strata)
+    missing = set(indices) - set(models)
+    if missing:
+        raise ValueError(f"No models for strata: {sorted(map(stratum_name, missing))}")
+
+    for key, idx in indices.items():
+        model_icv, model_rois = models[key]
+        covars = covars_fn(data.iloc[idx], mod, model_icv.get('age_center'))
+        with stage("apply_ICV", stratum=stratum_name(key), samples=len(idx)):
+            icv_adj[idx] = covars['ICV_adj'] = apply_model(icv[idx][:, None], covars, model_icv)[:, 0]
+        with stage("apply_features", stratum=stratum_name(key), samples=len(idx), features=features.shape[1]):
+            for start in range(0, features.shape[1], chunksize):
+                cols = slice(start, min(start + chunksize, features.shape[1]))
+                x = np.asarray(features[:, cols][idx], dtype=float)
+                out[idx, cols] = apply_model(x, covars, model_features(model_rois, cols))
+    _fill_unassigned(out, indices)
+
+    data_adj = data.copy()
+    data_adj[icv_col] = icv_adj
+    return data_adj
+
+## Model files
+
+def model_path(models_dir, mod, step, ref, key, eb):
+    """results/models/ComBat-{mod}_{step}_from-{ref}[_{stratum}]_eb-{eb}.pickle"""
+    name = stratum_name(key)
+    stratum = f"_{name}" if name else ""
+    return os.path.join(models_dir, f'ComBat-{mod}_{step}_from-{ref}{stratum}_eb-{eb}.pickle')
+
+def manifest_path(models_dir, mod, ref, eb):
+    """results/models/ComBat-{mod}_from-{ref}_eb-{eb}.json, the version of a saved set of models"""
+    return os.path.join(models_dir, f'ComBat-{mod}_from-{ref}_eb-{eb}.json')
+
+def read_manifest(models_dir, mod, ref, eb):
+    """The manifest of a saved set of models, or None while one is being saved (or for sets saved without one)."""
+    try:
+        with open(manifest_path(models_dir, mod, ref, eb)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+@traced
+def save_models(models, models_dir, mod, ref, eb):
+    """
+    Saves each stratum's models as pickles and as memory-mappable .combat artifacts. The set's manifest is
+    removed first and written last, so readers can tell a complete set from one being saved.
+    """
+    manifest = manifest_path(models_dir, mod, ref, eb)
+    if os.path.exists(manifest):
+        os.remove(manifest)
+    for key, stratum_models in models.items():
+        for step, model in zip(("ICV", "ROIs"), stratum_models):
+            path = model_path(models_dir, mod, step, ref, key, eb)
+            with open(path, mode='wb') as file:
+                pickle.dump(model, file)
+            save_artifact(model, artifact_path(path))
+    with open(manifest, 'w') as f:
+        json.dump({'strata': [stratum_name(key) for key in models], 'saved_ns': time.time_ns()}, f)
+
+@traced
+def load_models(models_dir, mod, ref, eb, keys=(None,)):
+    """Loads each stratum's models, from .combat artifacts (memory-mapped) where they exist, else from pickles."""
+    models = {}
+    for key in keys:
+        stratum_models = []
+        for step in ("ICV", "ROIs"):
+            path = model_path(models_dir, mod, step, ref, key, eb)
+            if os.path.exists(os.path.join(artifact_path(path), 'header.json')):
+                stratum_models.append(load_artifact(artifact_path(path)))
+            else:
+                with open(path, 'rb') as f:
+                    stratum_models.append(pickle.load(f))
+        models[key] = tuple(stratum_models)
+    return models
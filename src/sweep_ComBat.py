@@ -0,0 +1,201 @@
+import os
+import json
+import hashlib
+import itertools
+import inspect
+import importlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from deriv_store import deriv_path, FORMATS
+from stratified_ComBat import MODS, model_path
+from pipeline_trace import traced
+
+PROJECT_ROOT = "/Users/vgonzenb/PennSIVE/MSKIDS/"
+DATA_DIR = os.path.join("data", "deriv")
+MODELS_DIR = os.path.join("results", "models")
+SWEEP_DIR = os.path.join("results", "sweep")
+
+SPLITS = (None, "MF")
+REFS = ("HC", "HC+MS")
+SEXES = ("MALE", "FEMALE")
+
+# modules whose code every task runs; a change to any of them reruns the sweep
+ENGINE = ["combat_model.py", "stratified_ComBat.py", "deriv_store.py", "model_artifact.py", "model_store.py",
+          "pipeline_trace.py"]
+
+
+def _models(ref, mod, eb, keys):
+    return [model_path(PROJECT_ROOT + MODELS_DIR, mod, step, ref, key, eb) for key in keys for step in ("ICV", "ROIs")]
+
+def _deriv(stem, fmt):
+    return deriv_path(PROJECT_ROOT + DATA_DIR, stem, fmt)
+
+def sweep_tasks(mods=MODS, ebs=(True, False), splits=SPLITS, refs=REFS, fmt="csv"):
+    """
+    Expands the grid mods x ebs x splits x refs into learn tasks and the apply tasks of their models, as
+    {task id: task}. A task names the script function it runs with its kwargs, the files it reads and writes,
+    and the tasks it depends on (whose outputs it reads).
+
+    Only combinations with a script are expanded: HC+MS models are split by sex (learn_apply_ComBat_to_all.py,
+    which also adjusts the MS data), and the apply scripts use eb=True models, unsplit ones GAM only.
+    """
+    ext = FORMATS[fmt]
+    hc, ms = _deriv("HC_data", fmt), _deriv("MS_data", fmt)
+    tasks = {}
+    for mod, eb, split, ref in itertools.product(mods, ebs, splits, refs):
+        tag = f"{mod}_split-{split}_eb-{eb}"
+        if ref == "HC" and split is None:
+            learn = f"learn_HC_{tag}"
+            tasks[learn] = dict(script="learn_ComBat-GAM", function="harmonize_data",
+                                kwargs=dict(data_file="HC_data" + ext, mod=mod, eb=eb, fmt=fmt),
+                                inputs=[hc], outputs=[_deriv(f'HC_data_adj_ComBat-{mod}_split-None_eb-{eb}', fmt)]
+                                + _models("HC_data", mod, eb, (None,)), deps=[])
+            if mod == "GAM" and eb:
+                tasks[f"apply_HC_{tag}"] = dict(script="apply_ComBat-GAM", function="apply_harmonization",
+                                                kwargs=dict(data_file="MS_data" + ext, fmt=fmt),
+                                                inputs=[ms] + _models("HC_data", mod, eb, (None,)),
+                                                outputs=[_deriv('MS_data_adj-ComBat-GAM_from-HC_split-None_eb-True', fmt)],
+                                                deps=[learn])
+        elif ref == "HC":
+            learn = f"learn_HC_{tag}"
+            tasks[learn] = dict(script="learn_ComBat_by_sex", function="harmonize_data_by_sex",
+                                kwargs=dict(data_file="HC_data" + ext, mod=mod, eb=eb, fmt=fmt),
+                                inputs=[hc], outputs=[_deriv(f'HC_data_adj_ComBat-{mod}_split-MF_eb-{eb}', fmt)]
+                                + _models("HC_data", mod, eb, SEXES), deps=[])
+            if eb:
+                tasks[f"apply_HC_{tag}"] = dict(script="apply_ComBat_by_sex", function="apply_harmonization_by_sex",
+                                                kwargs=dict(data_file="MS_data" + ext, mod=mod, fmt=fmt),
+                                                inputs=[ms] + _models("HC_data", mod, eb, SEXES),
+                                                outputs=[_deriv(f'MS_data_adj-ComBat-{mod}_from-HC_split-MF_eb-True', fmt)],
+                                                deps=[learn])
+        elif split == "MF":
+            if fmt == "parquet":
+                adjusted = [_deriv(f'HC+MS_adj_ComBat-{mod}_from-HC+MS_split-MF_eb-{eb}', fmt)]
+            else:
+                adjusted = [_deriv(f'{cohort}_adj_ComBat-{mod}_from-HC+MS_split-MF_eb-{eb}', fmt) for cohort in ("HC", "MS", "HC+MS")]
+            tasks[f"learn_HC+MS_{tag}"] = dict(script="learn_apply_ComBat_to_all", function="harmonize_all_data_by_sex",
+                                               kwargs=dict(data_file1="HC_data" + ext, data_file2="MS_data" + ext,
+                                                           mod=mod, eb=eb, fmt=fmt),
+                                               inputs=[hc, ms], outputs=adjusted + _models("HC+MS", mod, eb, SEXES), deps=[])
+    return tasks
+
+def _file_hash(path, h):
+    if os.path.isdir(path): # partitioned parquet datasets
+        for root, dirs, files in sorted(os.walk(path)):
+            dirs.sort()
+            for name in sorted(files):
+                h.update(os.path.relpath(os.path.join(root, name), path).encode())
+                _file_hash(os.path.join(root, name), h)
+        return
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+def task_fingerprint(task):
+    """Content hash of a task's parameters, input files and code (its script and the engine modules)."""
+    h = hashlib.sha256(json.dumps({k: task[k] for k in ("script", "function", "kwargs")}, sort_keys=True).encode())
+    src = os.path.dirname(os.path.abspath(__file__))
+    for path in task['inputs'] + [os.path.join(src, f"{task['script']}.py")] + [os.path.join(src, m) for m in ENGINE]:
+        h.update(os.path.basename(path).encode())
+        _file_hash(path, h)
+    return h.hexdigest()
+
+def _run_task(script, function, kwargs, project_root):
+    module = importlib.import_module(script)
+    module.PROJECT_ROOT = project_root
+    fn = getattr(module, function)
+    if 'n_jobs' in inspect.signature(fn).parameters:
+        kwargs = dict(kwargs, n_jobs=1) # tasks, not strata, are run in parallel
+    fn(**kwargs)
+
+def _manifest_path():
+    return os.path.join(PROJECT_ROOT + SWEEP_DIR, "manifest.json")
+
+def _load_manifest():
+    try:
+        with open(_manifest_path()) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _save_manifest(manifest):
+    os.makedirs(PROJECT_ROOT + SWEEP_DIR, exist_ok=True)
+    tmp = _manifest_path() + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, _manifest_path())
+
+@traced
+def run_sweep(mods=MODS, ebs=(True, False), splits=SPLITS, refs=REFS, fmt="csv", n_jobs=None, force=False, dry_run=False):
+    """
+    Runs the learn and apply tasks of the grid (see sweep_tasks), independent tasks concurrently in n_jobs
+    processes, each task once the tasks it depends on are done. Scripts run with n_jobs=1 inside the sweep's pool.
+
+    A task is skipped when its fingerprint (parameters, input files, code) matches the one recorded in
+    results/sweep/manifest.json by the last run that completed it and its outputs still exist, unless force.
+    Tasks downstream of a failed task are not run. With dry_run, only prints what would run.
+    Returns {task id: "ran", "skipped", "failed: ...", "blocked" or "would run"}.
+    """
+    tasks = sweep_tasks(mods, ebs, splits, refs, fmt)
+    os.makedirs(PROJECT_ROOT + MODELS_DIR, exist_ok=True)
+    manifest = _load_manifest()
+    status = {}
+
+    def ready():
+        submitted = {task_id for task_id, _ in running.values()}
+        return [task_id for task_id, task in tasks.items() if task_id not in status and task_id not in submitted
+                and all(status.get(dep) in ("ran", "skipped", "would run") for dep in task['deps'])]
+
+    def blocked():
+        for task_id, task in tasks.items():
+            if task_id not in status and any(status.get(dep, "").startswith(("failed", "blocked")) for dep in task['deps']):
+                status[task_id] = "blocked"
+                print(f"{task_id}: blocked")
+
+    def finish(task_id, fingerprint, error=None):
+        if error is None:
+            status[task_id] = "ran"
+            manifest[task_id] = fingerprint
+            _save_manifest(manifest)
+        else:
+            status[task_id] = f"failed: {type(error).__name__}: {error}"
+        print(f"{task_id}: {status[task_id]}")
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 and not dry_run else None
+    running = {}
+    try:
+        while len(status) < len(tasks):
+            blocked()
+            for task_id in ready():
+                task = tasks[task_id]
+                if dry_run:
+                    status[task_id] = "would run"
+                    print(f"{task_id}: would run")
+                    continue
+                fingerprint = task_fingerprint(task)
+                if not force and manifest.get(task_id) == fingerprint and all(map(os.path.exists, task['outputs'])):
+                    status[task_id] = "skipped"
+                    print(f"{task_id}: skipped")
+                    continue
+                args = (task['script'], task['function'], task['kwargs'], PROJECT_ROOT)
+                if pool is None:
+                    try:
+                        _run_task(*args)
+                        finish(task_id, fingerprint)
+                    except Exception as error:
+                        finish(task_id, fingerprint, error)
+                else:
+                    running[pool.submit(_run_task, *args)] = (task_id, fingerprint)
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task_id, fingerprint = running.pop(future)
+                    finish(task_id, fingerprint, future.exception())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return status
+
+if __name__ == "__main__":
+    run_sweep()
@@ -0,0 +1,25 @@
+import unittest
+import numpy as np
+from benchmark_ComBat import synthetic_cohort
+from stratified_ComBat import learn_strata, feature_columns, covars_by_sex
+
+
+class ScaleInvarianceTest(unittest.TestCase):
+    """Harmonized ROIs do not depend on the units ICV is given in (it enters the ROI step's design)."""
+
+    def test_icv_units(self):
+        data, _ = synthetic_cohort(n_sites=4, n_per_site=60, n_features=10)
+        icv_col, roi_cols = feature_columns(data)
+        for mod in ("GAM", "Linear"):
+            with self.subTest(mod=mod):
+                _, adjusted = learn_strata(data, covars_by_sex, "sex", mod, n_jobs=1)
+                _, rescaled = learn_strata(data.assign(**{icv_col: data[icv_col] * 1000}), covars_by_sex, "sex", mod,
+                                           n_jobs=1)
+                expected = adjusted[roi_cols].to_numpy()
+                np.testing.assert_allclose(rescaled[roi_cols].to_numpy(), expected, rtol=0,
+                                           atol=1e-6 * np.abs(expected).max())
+                np.testing.assert_allclose(rescaled[icv_col].to_numpy(), adjusted[icv_col].to_numpy() * 1000, rtol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import http.client
+from http.server import ThreadingHTTPServer
+import numpy as np
+from benchmark_ComBat import synthetic_cohort
+from stratified_ComBat import learn_strata, save_models, model_path, manifest_path, covars_by_sex
+from model_artifact import save_artifact, artifact_path
+from harmonization_service import ModelCache, MicroBatcher, HarmonizationHandler
+
+
+class HarmonizationServiceTest(unittest.TestCase):
+    """Requests to a service on Linear models learned by sex from a small synthetic cohort."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data, _ = synthetic_cohort(n_sites=3, n_per_site=40, n_features=5)
+        models, _ = learn_strata(cls.data, covars_by_sex, "sex", "Linear", n_jobs=1)
+        cls.models_dir = tempfile.mkdtemp(prefix="harmonization_service_")
+        save_models(models, cls.models_dir, "Linear", "HC_data", True)
+
+        cache = ModelCache(cls.models_dir, "Linear", "HC_data", True, keys=("MALE", "FEMALE"))
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), HarmonizationHandler)
+        cls.server.batcher = MicroBatcher(cache, covars_by_sex, "sex")
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.models_dir, ignore_errors=True)
+
+    def post(self, body):
+        connection = http.client.HTTPConnection(*self.server.server_address, timeout=30)
+        try:
+            connection.request("POST", "/harmonize", body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def scans(self, n=3):
+        return json.loads(self.data.head(n).to_json(orient='records'))
+
+    def test_harmonizes_scans(self):
+        status, body = self.post(json.dumps(self.scans()))
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body['rows']), 3)
+
+    def test_empty_payloads(self):
+        for payload in ("", "[]", '{"rows": []}', "[{}]"):
+            with self.subTest(payload=payload):
+                status, body = self.post(payload)
+                self.assertEqual(status, 400)
+                self.assertIn('error', body)
+
+    def test_malformed_payloads(self):
+        for payload in ("not json", '{"scans": []}', "5", "[1, 2]", '"x"'):
+            with self.subTest(payload=payload):
+                status, body = self.post(payload)
+                self.assertEqual(status, 400)
+                self.assertIn('error', body)
+
+    def test_features_by_name(self):
+        scans = self.scans()
+        reordered = [dict(reversed(list(scan.items()))) for scan in scans] # ROIs before ICV
+        status, body = self.post(json.dumps(reordered))
+        self.assertEqual(status, 200)
+        self.assertEqual(body['rows'], self.post(json.dumps(scans))[1]['rows'])
+
+    def test_missing_or_unknown_features(self):
+        missing = [{k: v for k, v in scan.items() if k != 'DLICV'} for scan in self.scans()]
+        unknown = [dict(scan, R99=1.0) for scan in self.scans()]
+        for name, scans in (('missing', missing), ('unknown', unknown), ('missing', [{"site": "SITE0"}])):
+            with self.subTest(name=name):
+                status, body = self.post(json.dumps(scans))
+                self.assertEqual(status, 400)
+                self.assertIn(name, body['error'])
+
+    def test_unexpected_errors(self):
+        class Failing:
+            def submit(self, data):
+                raise RuntimeError("worker died")
+
+        batcher, self.server.batcher = self.server.batcher, Failing()
+        try:
+            status, body = self.post(json.dumps(self.scans()))
+        finally:
+            self.server.batcher = batcher
+        self.assertEqual(status, 500)
+        self.assertIn("worker died", body['error'])
+
+
+class MicroBatcherTest(unittest.TestCase):
+
+    def test_worker_survives_cache_errors(self):
+        class Unreadable:
+            mod = "Linear"
+
+            def get(self):
+                raise pickle.UnpicklingError("pickle data was truncated")
+
+            def features(self):
+                return None
+
+        batcher = MicroBatcher(Unreadable(), covars_by_sex, "sex", timeout=10)
+        data, _ = synthetic_cohort(n_sites=2, n_per_site=5, n_features=3)
+        for _ in range(2): # the second request is served by the same worker
+            with self.assertRaises(pickle.UnpicklingError):
+                batcher.submit(data)
+
+
+class ModelCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.models_dir = tempfile.mkdtemp(prefix="model_cache_")
+        data, _ = synthetic_cohort(n_sites=3, n_per_site=40, n_features=5)
+        self.old, _ = learn_strata(data, covars_by_sex, "sex", "Linear", n_jobs=1)
+        self.new, _ = learn_strata(data.assign(R0=data.R0 * 2), covars_by_sex, "sex", "Linear", n_jobs=1)
+        save_models(self.old, self.models_dir, "Linear", "HC_data", True)
+
+    def tearDown(self):
+        shutil.rmtree(self.models_dir, ignore_errors=True)
+
+    def test_reloads_whole_sets(self):
+        cache = ModelCache(self.models_dir, "Linear", "HC_data", True, keys=("MALE", "FEMALE"), poll=0)
+        served = cache.get()
+
+        # save_models caught after the first ICV model: the old set is kept
+        os.remove(manifest_path(self.models_dir, "Linear", "HC_data", True))
+        path = model_path(self.models_dir, "Linear", "ICV", "HC_data", "MALE", True)
+        with open(path, 'wb') as file:
+            pickle.dump(self.new["MALE"][0], file)
+        save_artifact(self.new["MALE"][0], artifact_path(path))
+        time.sleep(0.01)
+        self.assertIs(cache.get(), served)
+
+        save_models(self.new, self.models_dir, "Linear", "HC_data", True)
+        time.sleep(0.01)
+        reloaded = cache.get()
+        for key in ("MALE", "FEMALE"):
+            for model, expected in zip(reloaded[key], self.new[key]):
+                np.testing.assert_array_equal(model['B_hat'], expected['B_hat'])
+
+
+if __name__ == "__main__":
+    unittest.main()
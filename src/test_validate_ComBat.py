@@ -0,0 +1,31 @@
+import unittest
+from benchmark_ComBat import synthetic_cohort
+from stratified_ComBat import covars_by_sex
+from validate_ComBat import validate_strata
+
+
+class ValidateStrataTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data, _ = synthetic_cohort(n_sites=3, n_per_site=30, n_features=4)
+
+    def test_without_bootstrap(self):
+        intervals, holdout = validate_strata(self.data, covars_by_sex, "sex", "Linear", n_boot=0, n_jobs=1)
+        self.assertIsNone(intervals)
+        self.assertEqual(len(holdout), 2 * 3 * 5) # strata x held-out sites x (ICV + ROIs)
+
+    def test_bootstrap(self):
+        intervals, _ = validate_strata(self.data, covars_by_sex, "sex", "Linear", n_boot=4, leave_site_out=False,
+                                       n_jobs=1)
+        self.assertEqual(len(intervals), 2 * 2 * 3 * 5) # params x strata x sites x (ICV + ROIs)
+        self.assertTrue(intervals.se.notna().all())
+
+    def test_invalid_n_boot(self):
+        for n_boot in (-1, 1):
+            with self.subTest(n_boot=n_boot), self.assertRaisesRegex(ValueError, "n_boot"):
+                validate_strata(self.data, covars_by_sex, "sex", "Linear", n_boot=n_boot, n_jobs=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+from deriv_store import read_deriv, write_deriv, deriv_path, deriv_stem
+from stratified_ComBat import update_strata, load_models, save_models, covars_by_sex
+from pipeline_trace import traced
+
+# Specify directories
+PROJECT_ROOT = "/Users/vgonzenb/PennSIVE/MSKIDS/"
+DATA_DIR = os.path.join("data", "deriv")
+MODELS_DIR = os.path.join("results", "models")
+
+@traced
+def update_harmonization_by_sex(data_file = "HC_new.csv", ref = "HC_data", mod = "GAM", eb = True, n_jobs=None, fmt="csv"):
+    """
+    Adds newly scanned Healthy Controls to the models learned from ref by learn_ComBat_by_sex.py, separately for
+    males and females, without refitting on ref. New controls may come from sites the models have not seen.
+    The models are saved in place of the old ones; fmt sets the format (csv or parquet) of the adjusted new data.
+    """
+    # Load new HC data (.csv or .parquet)
+    data = read_deriv(os.path.join(PROJECT_ROOT + DATA_DIR, data_file))
+
+    # Load ICV and ROI models for males and females
+    models = load_models(PROJECT_ROOT + MODELS_DIR, mod, ref, eb, keys=("MALE", "FEMALE"))
+
+    # update Steps 1 and 2 for males and females in parallel
+    models, data_adj = update_strata(models, data, covars_by_sex, strata="sex", mod=mod, n_jobs=n_jobs)
+
+    # save adjusted new data as .csv or .parquet
+    write_deriv(data_adj, deriv_path(PROJECT_ROOT + DATA_DIR, f'{deriv_stem(data_file)}_adj_ComBat-{mod}_split-MF_eb-{eb}', fmt))
+
+    # replace the models, which now also cover data_file
+    save_models(models, PROJECT_ROOT + MODELS_DIR, mod, ref, eb)
+
+if __name__ == "__main__":
+    update_harmonization_by_sex(mod="Linear")
@@ -0,0 +1,205 @@
+import os
+import numpy as np
+import pandas as pd
+from combat_model import design_matrix, site_index, site_moments, fit_location_scale, eb_parametric, site_stats, resample_model
+from stratified_ComBat import learn_strata, strata_indices, _run, stratum_name, feature_columns, covars_with_sex, covars_by_sex
+from deriv_store import read_deriv
+from pipeline_trace import stage, traced
+
+PROJECT_ROOT = "/Users/vgonzenb/PennSIVE/MSKIDS/"
+DATA_DIR = os.path.join("data", "deriv")
+VALIDATION_DIR = os.path.join("results", "validation")
+
+BOOT_BLOCK = 50 # resamples per parallel job, each drawn from its own SeedSequence child
+
+
+## Resampled two-step fits
+
+def _stratum_arrays(icv, rois, covars, models):
+    """
+    A stratum's samples in the layout of its full-data fit, built once and shared by all its resamples:
+    the covariate columns of the ICV and ROI designs (the latter with raw ICV, as in the ROI model's statistics)
+    and the samples' site positions.
+    """
+    model_icv, model_rois = models
+    n_batch = len(model_icv['SITE_labels'])
+    x_icv = design_matrix(covars.drop(columns='ICV_adj'), model_icv)[:, n_batch:]
+    x_rois = design_matrix(covars, model_rois)[:, n_batch:]
+    x_rois[:, model_rois['stats']['icv_col']] = icv
+    return x_icv, icv[:, None], x_rois, rois, site_index(covars, model_icv)
+
+def _adjust_site(model, x, data):
+    """
+    Harmonizes the samples of one site the model was not fit on (data, with covariate columns x) to it:
+    the site's location and scale are estimated from its own standardized data, with the model's kind of EB.
+    """
+    n_batch = len(model['SITE_labels'])
+    mean = model['stand_mean'][:, 0] + x @ model['B_hat'][n_batch:]
+    sd = np.sqrt(model['var_pooled'][:, 0])
+    s_data = (data - mean) / sd
+    n, s1, s2 = site_moments(s_data, np.zeros(len(data), dtype=int), 1)
+    LS = fit_location_scale(n, s1, s2, eb=model['eb'])
+    gamma, delta = eb_parametric(n, s1, s2, LS) if model['eb'] else (LS['gamma_hat'], LS['delta_hat'])
+    return (s_data - gamma) / np.sqrt(delta) * sd + mean
+
+def _leave_site_out(arrays, adjusted, models, site, warm_start):
+    """
+    Refits a stratum's two-step model without one site (from the full fit's statistics, no samples needed),
+    harmonizes that site's samples to it and returns their number and their RMS difference from the full fit's
+    harmonized values, in units of the full fit's pooled SD, for ICV and each ROI.
+    """
+    x_icv, icv, x_rois, rois, sites = arrays
+    model_icv, model_rois = models
+    keep = np.arange(len(model_icv['SITE_labels'])) != site
+    fit_icv = resample_model(model_icv, model_icv['stats'], keep, warm_start=warm_start)
+    fit_rois = resample_model(model_rois, model_rois['stats'], keep, icv_model=fit_icv, warm_start=warm_start)
+
+    rows = sites == site
+    icv_adj = _adjust_site(fit_icv, x_icv[rows], icv[rows])[:, 0]
+    x = x_rois[rows].copy()
+    x[:, model_rois['stats']['icv_col']] = icv_adj if model_rois['smooth_model']['perform_smoothing'] \
+        else icv_adj.astype(np.float32) # as _insert_icv_adj does
+    rois_adj = _adjust_site(fit_rois, x, rois[rows])
+
+    sd = np.concatenate([np.sqrt(model_icv['var_pooled'][:1, 0]), np.sqrt(model_rois['var_pooled'][:, 0])])
+    error = (np.column_stack([icv_adj, rois_adj]) - adjusted[rows]) / sd
+    return rows.sum(), np.sqrt((error ** 2).mean(axis=0))
+
+def _bootstrap_block(arrays, models, n_boot, seed, warm_start):
+    """
+    Site parameters (gamma_star, delta_star) of n_boot refits of a stratum's two-step model, each on samples drawn
+    with replacement within every site. Returns two n_boot x N_sites x (1 + N_ROIs) arrays, ICV first.
+    """
+    x_icv, icv, x_rois, rois, sites = arrays
+    model_icv, model_rois = models
+    n_batch = len(model_icv['SITE_labels'])
+    by_site = [np.flatnonzero(sites == i) for i in range(n_batch)]
+    rng = np.random.default_rng(seed)
+
+    gammas = np.empty((n_boot, n_batch, 1 + rois.shape[1]))
+    deltas = np.empty_like(gammas)
+    for b in range(n_boot):
+        weights = np.zeros(len(sites))
+        for rows in by_site:
+            weights[rows] = np.bincount(rng.integers(len(rows), size=len(rows)), minlength=len(rows))
+        fit_icv = resample_model(model_icv, site_stats(x_icv, icv, sites, n_batch, weights), warm_start=warm_start)
+        stats = site_stats(x_rois, rois, sites, n_batch, weights)
+        stats['icv_col'] = model_rois['stats']['icv_col']
+        fit_rois = resample_model(model_rois, stats, icv_model=fit_icv, warm_start=warm_start)
+        gammas[b] = np.column_stack([fit_icv['gamma_star'][:, 0], fit_rois['gamma_star']])
+        deltas[b] = np.column_stack([fit_icv['delta_star'][:, 0], fit_rois['delta_star']])
+    return gammas, deltas
+
+
+## Validation
+
+def _intervals(key, models, gammas, deltas, features, level):
+    """
+    A stratum's gamma and delta estimates with their bootstrap SE and percentile interval, one row each.
+    Estimates are refit from the full-data statistics the same way as the resamples, which gives the learned
+    model's up to rounding.
+    """
+    model_icv = resample_model(models[0], models[0]['stats'])
+    model_rois = resample_model(models[1], models[1]['stats'], icv_model=model_icv)
+    frames = []
+    for param, draws in (('gamma', gammas), ('delta', deltas)):
+        estimate = np.column_stack([np.asarray(model_icv[f'{param}_star'])[:, 0], np.asarray(model_rois[f'{param}_star'])])
+        lower, upper = np.quantile(draws, [(1 - level) / 2, (1 + level) / 2], axis=0)
+        for i, site in enumerate(model_icv['SITE_labels']):
+            frames.append(pd.DataFrame({'stratum': stratum_name(key), 'site': site, 'feature': features, 'param': param,
+                                        'estimate': estimate[i], 'se': draws[:, i].std(axis=0, ddof=1),
+                                        'lower': lower[i], 'upper': upper[i]}))
+    return frames
+
+@traced
+def validate_strata(data, covars_fn, strata=None, mod="GAM", eb=True, n_boot=200, leave_site_out=True, level=0.95,
+                    seed=0, n_jobs=None, warm_start=True):
+    """
+    Resampling checks of the two-step ICV->ROI model learn_strata fits to data (e.g. covars_by_sex within each sex):
+    how precisely the site effects are estimated, and how much each site's harmonized values depend on the site
+    being in the training data.
+
+    The full-data fit of each stratum is reused by every resample: refits are made from site_stats of the samples
+    on its design (resample_model), and with warm_start keep its GAM penalty weights and start EB from its
+    estimates. Resamples run concurrently in n_jobs processes: leave-one-site-out refits, one per site, and
+    n_boot bootstrap refits (samples drawn within sites) in blocks of BOOT_BLOCK, seeded from seed.
+
+    Returns two DataFrames, with ICV listed as the first feature:
+    - intervals (if n_boot, which must then be at least 2): per stratum, site, feature and param (gamma or delta),
+      the full-fit estimate, bootstrap SE and percentile interval at level;
+    - holdout (if leave_site_out): per stratum, held-out site and feature, the number of samples and the RMS
+      difference between their harmonization by the model fit without the site and by the full fit,
+      in units of the full fit's pooled SD.
+    """
+    if n_boot < 0 or n_boot == 1:
+        raise ValueError(f"n_boot must be 0 (no bootstrap) or at least 2 (for standard errors), got {n_boot}")
+    icv_col, roi_cols = feature_columns(data)
+    features = [icv_col] + list(roi_cols)
+    models, adjusted = learn_strata(data, covars_fn, strata, mod, eb, n_jobs=n_jobs)
+    for model_icv, model_rois in models.values():
+        if model_rois.get('eb_method', "parametric") != "parametric":
+            raise ValueError("only models with parametric empirical Bayes estimates can be resampled")
+
+    with stage("resample_jobs"):
+        strata_arrays, boot_jobs, loso_jobs = {}, {}, {}
+        for key, idx in strata_indices(data, strata).items():
+            rows = data.iloc[idx]
+            covars = covars_fn(rows, mod, models[key][0].get('age_center'))
+            covars['ICV_adj'] = adjusted[icv_col].to_numpy()[idx]
+            arrays = _stratum_arrays(rows[icv_col].to_numpy(dtype=float), rows[roi_cols].to_numpy(dtype=float),
+                                     covars, models[key])
+            blocks = [min(BOOT_BLOCK, n_boot - start) for start in range(0, n_boot, BOOT_BLOCK)]
+            seeds = np.random.SeedSequence([seed, len(strata_arrays)]).spawn(len(blocks))
+            boot_jobs.update({(key, i): (arrays, models[key], n, s, warm_start)
+                              for i, (n, s) in enumerate(zip(blocks, seeds))})
+            if leave_site_out:
+                stratum_adjusted = adjusted[features].to_numpy()[idx]
+                loso_jobs.update({(key, site): (arrays, stratum_adjusted, models[key], site, warm_start)
+                                  for site in range(len(models[key][0]['SITE_labels']))})
+            strata_arrays[key] = arrays
+
+    intervals = None
+    if n_boot:
+        with stage("bootstrap", strata=len(strata_arrays), resamples=n_boot, n_jobs=n_jobs):
+            draws = _run(_bootstrap_block, boot_jobs, n_jobs)
+        intervals = []
+        for key in strata_arrays:
+            block_draws = [d for (k, _), d in draws.items() if k == key]
+            gammas = np.concatenate([g for g, _ in block_draws])
+            deltas = np.concatenate([d for _, d in block_draws])
+            intervals += _intervals(key, models[key], gammas, deltas, features, level)
+        intervals = pd.concat(intervals, ignore_index=True)
+
+    if not leave_site_out:
+        return intervals, None
+    with stage("leave_site_out", strata=len(strata_arrays), n_jobs=n_jobs):
+        errors = _run(_leave_site_out, loso_jobs, n_jobs)
+    holdout = pd.concat([pd.DataFrame({'stratum': stratum_name(key), 'site': models[key][0]['SITE_labels'][site],
+                                       'feature': features, 'n': n, 'rmse_sd': rmse})
+                         for (key, site), (n, rmse) in errors.items()], ignore_index=True)
+    return intervals, holdout
+
+def validation_path(stem, mod, split, eb, table):
+    return os.path.join(PROJECT_ROOT + VALIDATION_DIR, f"{stem}_ComBat-{mod}_split-{split}_eb-{eb}_{table}.csv")
+
+@traced
+def validate_harmonization(data_file="HC_data.csv", mod="GAM", split="MF", eb=True, n_boot=200, seed=0, n_jobs=None):
+    """
+    validate_strata for the models of learn_ComBat-GAM.py (split=None) or learn_ComBat_by_sex.py (split="MF")
+    on a data/deriv table; writes the intervals (if n_boot) and holdout tables to results/validation.
+    """
+    data = read_deriv(os.path.join(PROJECT_ROOT + DATA_DIR, data_file))
+    if split == "MF":
+        intervals, holdout = validate_strata(data, covars_by_sex, "sex", mod, eb, n_boot, seed=seed, n_jobs=n_jobs)
+    else:
+        intervals, holdout = validate_strata(data, covars_with_sex, None, mod, eb, n_boot, seed=seed, n_jobs=n_jobs)
+
+    stem = os.path.splitext(data_file)[0]
+    os.makedirs(PROJECT_ROOT + VALIDATION_DIR, exist_ok=True)
+    if intervals is not None:
+        intervals.to_csv(validation_path(stem, mod, split, eb, "intervals"), index=False)
+    holdout.to_csv(validation_path(stem, mod, split, eb, "holdout"), index=False)
+    return intervals, holdout
+
+if __name__ == "__main__":
+    validate_harmonization()